@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks the hot paths of ipread on synthetic image plate readouts.
+
+The readout stacks are generated locally, so no network access is needed.
+Each stage (reading, .inf parsing, scalefactor estimation, HDR assembly and
+PSL conversion) is timed separately and its throughput in MPix/s and peak
+memory (python 3 only) are reported. With --check, the results are checked
+against the exact assembly of the full image before (see `check`).
+
+Author: Stephan Kuschel
+'''
+
+
+from __future__ import absolute_import, division, print_function
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+import ipread
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+
+def writeinf(filename, rows, cols, R=50, S=4000.0, L=5.0, t=None, name='synthetic'):
+    '''
+    writes an .inf file describing a readout with the given settings.
+    t is the readout time in seconds since the epoch.
+    '''
+    t = time.time() if t is None else t
+    lines = ['BAS_IMAGE_FILE', name, '20x40', R, R, 16, cols, rows, S, L,
+             time.asctime(time.localtime(t)), 0]
+    with open(filename, 'w') as f:
+        f.write(''.join('{}\n'.format(line) for line in lines))
+
+
+def syntheticstack(directory, name='plate', rows=2000, cols=1000, readouts=3,
+                   fading=0.7, noise=0.01, saturation=0.01, R=50, S=4000.0, L=5.0,
+                   seed=0):
+    '''
+    creates the .inf and .img files of readouts readouts of a synthetic
+    image plate in directory and returns their filenames (without extension).
+
+    The signal of every readout is fading times the signal of the
+    previous readout with a relative noise of noise. The signal is scaled,
+    such that the fraction saturation of all pixels of the first readout
+    is saturated.
+    '''
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[:rows, :cols] / float(max(rows, cols))
+    # smooth background with some bright spots
+    psl = 1 + 10 * np.exp(-((x - 0.3) ** 2 + (y - 0.5) ** 2) / 0.02)
+    for cx, cy in rng.uniform(0, 1, size=(20, 2)):
+        psl += rng.lognormal(3, 1) * np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / 1e-4)
+    # inverse of ipread.cnttopsl
+    cnt = 65536 * (np.log10(psl / ((R / 100.) ** 2 * (4000. / S))) / L + 0.5)
+    cnt += 65525 - np.percentile(cnt, 100 * (1 - saturation))
+    t0 = time.time()
+    files = []
+    for n in range(readouts):
+        c = cnt + 65536 * np.log10(fading) * n / L
+        c += 65536 * np.log10(np.clip(1 + noise * rng.randn(rows, cols), 1e-3, None)) / L
+        filename = os.path.join(directory, '{}_{}'.format(name, n + 1))
+        np.clip(np.rint(c), 0, 65535).astype('>u2').tofile(filename + '.img')
+        writeinf(filename + '.inf', rows, cols, R=R, S=S, L=L, t=t0 + 60 * n, name=name)
+        files.append(filename)
+    return files
+
+
+def ratiostats(ip, method):
+    '''
+    estimates the statistics of all pairs of consecutive readouts of ip
+    using the method method (see `ipread.IPreader`).
+    '''
+    ip.sf_method = method
+    return [ip._ratiostats(n) for n in range(len(ip.raw) - 1)]
+
+
+def measure(func, repeat=3):
+    '''
+    calls func repeat times and returns the best wall time in seconds and
+    the peak memory allocated during a call in bytes (None on python 2).
+    '''
+    best, peak = np.inf, None
+    for _ in range(repeat):
+        if tracemalloc is not None:
+            tracemalloc.start()
+        t = time.time()
+        func()
+        best = min(best, time.time() - t)
+        if tracemalloc is not None:
+            peak = max(peak or 0, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+    return best, peak
+
+
+def run(rows=2000, cols=1000, readouts=3, fading=0.7, noise=0.01, saturation=0.01,
+        repeat=3, directory=None):
+    '''
+    runs all benchmarks and returns a list of (stage, seconds, MPix/s, peak bytes).
+    '''
+    tmpdir = tempfile.mkdtemp(prefix='ipread-bench-') if directory is None else directory
+    try:
+        files = syntheticstack(tmpdir, rows=rows, cols=cols, readouts=readouts,
+                               fading=fading, noise=noise, saturation=saturation)
+        ip = ipread.IPreader(*[f + '.inf' for f in files])
+        single = ipread.IPreader(*[f + '.inf' for f in files], precision='single')
+        mpix = rows * cols / 1e6
+        buf = np.empty((readouts, rows, cols))  # reused by every call of readimgs
+        stages = [
+            ('readimg', readouts, lambda: [ipread.readimg(f, rows, cols) for f in files]),
+            ('readimgs', readouts, lambda: ipread.readimgs(files, rows, cols, out=buf)),
+            ('readimg memmap', readouts,
+             lambda: [np.sum(ipread.readimg(f, rows, cols, memmap=True)) for f in files]),
+            ('Infreader', None, lambda: [ipread.Infreader(f + '.inf') for f in files]),
+            ('scaninfs', None, lambda: ipread.scaninfs(tmpdir)),
+            ('IPreader', readouts, lambda: ipread.IPreader(*[f + '.inf' for f in files])),
+            ('IPreader align', readouts,
+             lambda: ipread.IPreader(*[f + '.inf' for f in files], align=True))]
+        for method in sorted(ipread._RATIOSTATS):
+            stages.append(('scalefactors ' + method, 2 * (readouts - 1),
+                           lambda method=method: ratiostats(ip, method)))
+        stages += [
+            ('HDR assembly', readouts, ip.assemble),
+            ('HDR assembly single', readouts, single.assemble),
+            ('psl', 1, ip.getpsl),
+            ('psl single', 1, single.getpsl),
+            ('psl lut', 1, lambda: ip.topsl(ipread.readimg(files[0], rows, cols, memmap=True)))]
+        results = []
+        for stage, images, func in stages:
+            seconds, peak = measure(func, repeat=repeat)
+            throughput = None if images is None else images * mpix / seconds
+            results.append((stage, seconds, throughput, peak))
+        return results
+    finally:
+        if directory is None:
+            shutil.rmtree(tmpdir)
+
+
+def check(rows=500, cols=400, readouts=3, fading=0.7, noise=0.01, saturation=0.01,
+          directory=None):
+    '''
+    checks the results of ipread on a synthetic stack against the exact
+    full image assembly and raises an AssertionError on the first mismatch.
+    Returns the names of the checks done.
+    '''
+    tmpdir = tempfile.mkdtemp(prefix='ipread-check-') if directory is None else directory
+    try:
+        files = syntheticstack(tmpdir, rows=rows, cols=cols, readouts=readouts,
+                               fading=fading, noise=noise, saturation=saturation)
+        infs = [f + '.inf' for f in files]
+        ip = ipread.IPreader(*infs)
+        done = []
+
+        # the median estimators agree with 'exact' within sf_tolerance, 'sample'
+        # within a few of its standard errors of about sf_tolerance. 'clipped'
+        # and 'wls' estimate the mean of the quotients, which differs from the
+        # median by less than the standard deviation of the scalefactors.
+        for method in sorted(ipread._RATIOSTATS):
+            for blocksize in (None, rows // 7):
+                sf = ipread.IPreader(*infs, sf_method=method, blocksize=blocksize)
+                if method in ('clipped', 'wls'):
+                    limit = ip.scalefactorsstd
+                else:
+                    limit = (4 if method == 'sample' else 1) * sf.sf_tolerance * ip.scalefactors
+                assert np.all(np.abs(sf.scalefactors - ip.scalefactors) <= limit), \
+                    'sf_method {} blocksize {}: {} != {}'.format(
+                        method, blocksize, sf.scalefactors, ip.scalefactors)
+            done.append('sf_method ' + method)
+
+        # regions of interest are the crop of the full image
+        for roi in (np.s_[rows // 3:rows // 2, cols // 4:], np.s_[::3, cols // 2:cols // 2 + 7]):
+            for align in (False, True):
+                full = ip if not align else ipread.IPreader(*infs, align=True)
+                sub = full.readroi(roi)
+                assert np.array_equal(sub.raw_hdr, full.raw_hdr[roi]), 'readroi {}'.format(roi)
+                assert np.array_equal(sub.count, full.count[roi]), 'readroi {}'.format(roi)
+        done.append('readroi')
+
+        # adding the last readout gives the full assembly
+        inc = ipread.IPreader(*infs[:-1])
+        inc.add_readout(infs[-1])
+        assert np.allclose(inc.scalefactors, ip.scalefactors, rtol=1e-12, atol=0)
+        assert np.array_equal(inc.count, ip.count), 'add_readout count'
+        assert np.allclose(inc.raw_hdr, ip.raw_hdr, rtol=1e-12, atol=0), 'add_readout raw_hdr'
+        done.append('add_readout')
+
+        # the second read is loaded from the cache
+        cachedir = os.path.join(tmpdir, 'cache')
+        for _ in range(2):
+            cached = ipread.IPreader(*infs, cache=cachedir)
+        assert isinstance(cached.raw[0], np.memmap), 'cache was not used'
+        assert np.array_equal(cached.raw_hdr, ip.raw_hdr), 'cache raw_hdr'
+        assert np.array_equal(cached.count, ip.count), 'cache count'
+        assert np.array_equal(cached.scalefactors, ip.scalefactors), 'cache scalefactors'
+        done.append('cache')
+
+        try:
+            import h5py  # noqa: F401
+        except ImportError:
+            pass
+        else:
+            filename = os.path.join(tmpdir, 'plate.h5')
+            ip.save(filename)
+            loaded = ipread.IPreader.load(filename)
+            assert np.array_equal(loaded.raw_hdr, ip.raw_hdr), 'HDF5 raw_hdr'
+            assert np.array_equal(loaded.count, ip.count), 'HDF5 count'
+            assert np.array_equal(loaded.scalefactors, ip.scalefactors), 'HDF5 scalefactors'
+            assert np.allclose(loaded.psl, ip.psl, rtol=1e-12, atol=0), 'HDF5 psl'
+            done.append('HDF5')
+
+        # the documented error bounds of precision='single'
+        single = ipread.IPreader(*infs, precision='single')
+        valid = ip.raw_hdr > 0
+        error = np.abs(single.raw_hdr[valid] / ip.raw_hdr[valid] - 1)
+        assert error.max() < (readouts + 1) * 2**-24, 'single raw_hdr {}'.format(error.max())
+        error = np.abs(single.psl[valid] / ip.psl[valid] - 1)
+        assert error.max() < 1e-5, 'single psl {}'.format(error.max())
+        assert np.allclose(single.scalefactors, ip.scalefactors, rtol=0, atol=1e-6), \
+            'single scalefactors'
+        done.append('precision single')
+        return done
+    finally:
+        if directory is None:
+            shutil.rmtree(tmpdir)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmarks ipread on synthetic '
+                                     'image plate readouts.')
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--cols', type=int, default=1000)
+    parser.add_argument('--readouts', type=int, default=3)
+    parser.add_argument('--fading', type=float, default=0.7,
+                        help='signal ratio of consecutive readouts.')
+    parser.add_argument('--noise', type=float, default=0.01,
+                        help='relative noise of every pixel.')
+    parser.add_argument('--saturation', type=float, default=0.01,
+                        help='fraction of saturated pixels in the first readout.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='every stage is run repeat times and the best time is shown.')
+    parser.add_argument('--dir', default=None,
+                        help='directory to create the synthetic files in. '
+                        'Defaults to a temporary directory, which is removed afterwards.')
+    parser.add_argument('--check', action='store_true',
+                        help='check the results on the synthetic data before the timings.')
+    args = parser.parse_args()
+    if args.check:
+        done = check(rows=args.rows, cols=args.cols, readouts=args.readouts,
+                     fading=args.fading, noise=args.noise, saturation=args.saturation)
+        print('passed checks: {}'.format(', '.join(done)))
+    results = run(rows=args.rows, cols=args.cols, readouts=args.readouts, fading=args.fading,
+                  noise=args.noise, saturation=args.saturation, repeat=args.repeat,
+                  directory=args.dir)
+    print('{:24s} {:>10s} {:>10s} {:>12s}'.format('stage', 'time [s]', 'MPix/s', 'peak [MiB]'))
+    for stage, seconds, throughput, peak in results:
+        throughput = '-' if throughput is None else '{:.1f}'.format(throughput)
+        peak = '-' if peak is None else '{:.1f}'.format(peak / 2.**20)
+        print('{:24s} {:10.4f} {:>10s} {:>12s}'.format(stage, seconds, throughput, peak))
+
+
+if __name__ == '__main__':
+    main()
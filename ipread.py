@@ -11,40 +11,758 @@ Author: Stephan Kuschel
 
 from __future__ import absolute_import, division, print_function
 import os
+import math
 import warnings
 import glob
 import copy
+import hashlib
+import re
 import time
-import numpy as np
-import numexpr as ne
+import threading
+import importlib
+import contextlib
+import collections
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
 
 
-__all__ = ['Infreader', 'IPreader', 'cnttopsl', 'readimg', 'read']
+class _LazyModule(object):
+    '''
+    stands in for the module name, which is imported on first attribute
+    access only. Afterwards the module replaces this object as the global
+    alias.
+    '''
+
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+
+# numpy is imported on first use, so listing .inf files does not need it.
+np = _LazyModule('numpy', 'np')
+
+
+__all__ = ['Infreader', 'IPreader', 'cnttopsl', 'readimg', 'readimgs', 'read', 'findplates',
+           'scaninfs', 'batch', 'Watcher', 'blockreduce', 'IPstack']
 __version__ = '0.2.1'
 
 
 # ----- Functions -----
-def cnttopsl(cnt, R, S, L):
+def cnttopsl(cnt, R, S, L, out=None):
     '''
     converts a count number cnt to PSL using the given values for R,S, L.
-    numexpr is used for calculations.
+    numexpr is used for calculations. If out is given, the result is
+    written to out, which may be of lower precision (e.g. float32)
+    than the calculation.
     '''
+    import numexpr as ne
     return ne.evaluate('(R / 100.) ** 2 * (4000. / S) * '
-                       '10.**(L * (cnt / 65536.0 - 0.5))')
+                       '10.**(L * (cnt / 65536.0 - 0.5))',
+                       out=out, casting='same_kind')
+
+
+_PSLLUTS = {}
+
+
+def _psllut(R, S, L, dtype='float64'):
+    '''
+    returns the table of the PSL values of all 65536 possible raw counts
+    at the read out settings R, S, L. Tables are calculated once and cached.
+    '''
+    key = (R, S, L, np.dtype(dtype).str)
+    if key not in _PSLLUTS:
+        lut = cnttopsl(np.arange(65536, dtype=np.float64), R, S, L).astype(dtype)
+        lut.flags.writeable = False
+        _PSLLUTS[key] = lut
+    return _PSLLUTS[key]
+
+
+def _replace(src, dst):
+    '''
+    renames the file src to dst, replacing dst if it exists. Unlike
+    os.rename, this works on windows as well.
+    '''
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+        return
+    try:  # python 2
+        os.rename(src, dst)
+    except OSError:
+        if not os.path.exists(dst):
+            raise
+        os.remove(dst)  # not atomic, but only on windows
+        os.rename(src, dst)
+
+
+def _removeext(s):
+    return s[:-4] if s.endswith('.img') or s.endswith('.inf') else s
+
+
+def _expandfiles(args):
+    '''
+    returns the list of unique filenames without extension given by args.
+    See `IPreader` for the possible args.
+    '''
+    if len(args) == 1:
+        files = glob.glob(args[0])  # this always returns a list
+    elif len(args) > 1:  # List of filenames given
+        files = args
+    # make list unique, so every file is only read once if
+    # name* results in a list containing .img and .inf files.
+    return list(set(_removeext(f) for f in files))
+
+
+def _roislices(roi, rows, cols):
+    '''
+    returns the region of interest roi, a tuple (rowslice, colslice), as
+    slices with explicit bounds for an image of rows rows and cols cols.
+    '''
+    ret = tuple(slice(*s.indices(n)) for s, n in zip(roi, (rows, cols)))
+    if len(ret) != 2 or any(s.step < 1 for s in ret):
+        raise ValueError('roi must be a tuple of two slices with positive steps.')
+    return ret
+
+
+def _composerois(outer, inner):
+    '''
+    returns the region inner of the region outer as a single region.
+    Both must be normalized by `_roislices`, inner relative to outer.
+    '''
+    return tuple(slice(o.start + i.start * o.step, o.start + i.stop * o.step, o.step * i.step)
+                 for o, i in zip(outer, inner))
+
+
+# bytes read at once, when the data is converted while reading
+_READCHUNK = 2**22
+# a staging buffer of _READCHUNK bytes per thread
+_READBUFFERS = threading.local()
+
+
+def _imgfile(filename, rows, cols):
+    '''
+    returns the filename of the .img file filename (with or without '.img')
+    after checking that its size matches rows rows and cols cols.
+    '''
+    filename = filename if filename.endswith('.img') else filename + '.img'
+    size = os.path.getsize(filename)
+    if size != 2 * rows * cols:
+        raise ValueError('"{}" has {} bytes, but {} bytes are expected for {} rows and {} '
+                         'cols.'.format(filename, size, 2 * rows * cols, rows, cols))
+    return filename
+
+
+def _fadvise(f, advice):
+    '''
+    tells the OS how the file f, a filename or an open file, will be read.
+    advice is the name of an os.POSIX_FADV_* constant. Advice about the
+    access pattern (e.g. POSIX_FADV_SEQUENTIAL) only applies to the open
+    file it is given for. Does nothing, where this is not supported.
+    '''
+    if not hasattr(os, 'posix_fadvise'):  # python 2, windows and mac
+        return
+    fd = f.fileno() if hasattr(f, 'fileno') else os.open(f, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+    except OSError:
+        pass
+    finally:
+        if not hasattr(f, 'fileno'):  # opened here
+            os.close(fd)
+
+
+def _readfull(f, buf):
+    '''
+    fills the writeable buffer buf from the binary file f.
+    '''
+    view = memoryview(buf)
+    while len(view) > 0:
+        n = f.readinto(view)
+        if not n:
+            raise IOError('"{}" is truncated.'.format(f.name))
+        view = view[n:]
 
 
-def readimg(filename, rows, cols):
+def _readinto(filename, out):
+    '''
+    reads the big endian uint16 data of the .img file filename into the
+    contiguous array out of the same size. Native uint16 data is read
+    directly into out and byteswapped in place. Any other type is read in
+    chunks of _READCHUNK bytes into a staging buffer, which is reused by all
+    calls of the same thread, and converted to out while swapping the
+    bytes. Hence no memory is allocated besides out.
+    '''
+    import io
+    import sys
+    if not out.flags.c_contiguous or out.size * 2 != os.path.getsize(filename):
+        raise ValueError('out must be a contiguous array of the size of "{}".'.format(filename))
+    flat = out.reshape(-1)  # a view, as out is contiguous
+    with io.open(filename, 'rb', buffering=0) as f:
+        _fadvise(f, 'POSIX_FADV_SEQUENTIAL')
+        if flat.dtype == np.dtype(np.uint16):
+            _readfull(f, flat.view(np.uint8))
+            if sys.byteorder == 'little':
+                flat.byteswap(True)
+            return out
+        buf = getattr(_READBUFFERS, 'buf', None)
+        if buf is None:
+            buf = _READBUFFERS.buf = np.empty(_READCHUNK, dtype=np.uint8)
+        step = _READCHUNK // 2
+        for start in range(0, flat.size, step):
+            n = min(step, flat.size - start)
+            _readfull(f, buf[:2 * n])
+            np.copyto(flat[start:start + n], buf[:2 * n].view('>u2'), casting='unsafe')
+    return out
+
+
+def readimg(filename, rows, cols, dtype='float64', memmap=False, roi=None, out=None):
     '''
     Attempts to read the .img file filename (with or without '.img')
-    assuming it was read with rows rows and cols cols.
+    assuming it was read with rows rows and cols cols. A ValueError is
+    raised, if the size of the file does not match.
+
+    If a region of interest roi is given as tuple (rowslice, colslice),
+    e.g. `np.s_[100:200, :]`, only this window is returned and only the
+    parts of the file containing it are read from disk.
+
+    The data is returned as an array of type dtype. If out, a contiguous
+    array of the right shape, is given, the data is written to out instead
+    and converted to its type, so no new memory is allocated. If memmap is
+    True, the file is not read at all. Instead a read-only big endian uint16
+    `np.memmap` is returned, which holds the raw counts on disk. Those are
+    converted to floating point only when used, for example by
+    `np.asarray(img[rowslice], dtype=np.float32)`. In this case dtype is
+    ignored.
     '''
     import numpy as np
     dt = np.dtype(np.uint16)
     dt = dt.newbyteorder('>')  # change to big endian
-    filename = filename if filename.endswith('.img') else filename + '.img'
-    with open(filename, 'rb') as f:
-        ret = np.reshape(np.fromfile(f, dtype=dt), (rows, cols))
-    return np.array(ret, dtype=np.float64)
+    filename = _imgfile(filename, rows, cols)
+    if memmap or roi is not None:
+        ret = np.memmap(filename, dtype=dt, mode='r', shape=(rows, cols))
+        if roi is not None:
+            ret = ret[_roislices(roi, rows, cols)]
+        if memmap:
+            return ret
+        if out is None:
+            return np.array(ret, dtype=dtype)
+        np.copyto(out, ret, casting='unsafe')
+        return out
+    return _readinto(filename, np.empty((rows, cols), dtype=dtype) if out is None else out)
+
+
+def readimgs(filenames, rows, cols, dtype='float64', out=None):
+    '''
+    reads many .img files with rows rows and cols cols into a single array
+    of shape (len(filenames), rows, cols) and type dtype (see `readimg`).
+    The sizes of all files are checked before anything is read, and the OS
+    is asked to read ahead all of them, so the files are read at the
+    bandwidth of the disk.
+
+    out can be an array of that shape or a list of arrays of shape
+    (rows, cols), which is filled instead. Reusing out for a series of
+    plates with the same geometry avoids allocating memory for each plate.
+    '''
+    filenames = [_imgfile(f, rows, cols) for f in filenames]
+    if out is None:
+        out = np.empty((len(filenames), rows, cols), dtype=dtype)
+    if len(out) != len(filenames):
+        raise ValueError('out holds {} images, but {} files are given.'
+                         .format(len(out), len(filenames)))
+    for filename in filenames:
+        _fadvise(filename, 'POSIX_FADV_WILLNEED')
+    for filename, img in zip(filenames, out):
+        _readinto(filename, img)
+    return out
+
+
+def _strips(rows, blocksize=None):
+    '''
+    yields slices dividing rows rows into strips of at most blocksize rows.
+    A single strip covering all rows is returned, if blocksize is None.
+    '''
+    blocksize = rows if blocksize is None else max(int(blocksize), 1)
+    for start in range(0, rows, blocksize):
+        yield slice(start, min(start + blocksize, rows))
+
+
+def _outarray(out, shape, dtype):
+    '''
+    returns a zeroed array of the given shape and dtype to write results to.
+    out can be None (a new array is created), an existing array of matching
+    shape or a filename. In the latter case a `.npy` file is created and
+    returned as a writeable memory map.
+    '''
+    if out is None:
+        return np.zeros(shape, dtype=dtype)
+    if not hasattr(out, 'shape'):
+        return np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+    if tuple(out.shape) != tuple(shape):
+        raise ValueError('out has shape {}, but {} is needed.'.format(out.shape, shape))
+    out[...] = 0
+    return out
+
+
+def _realimg(img, rawminimum, rawsaturate, dtype='float64'):
+    '''
+    returns a copy of img as dtype with all over- and underexposed pixels
+    set to NaN.
+    '''
+    realimg = np.array(img, dtype=dtype)
+    realimg[(realimg > rawsaturate) | (realimg < rawminimum)] = np.nan
+    return realimg
+
+
+def _ratiostats_exact(a, b, rawminimum, rawsaturate, dtype='float64', **kwargs):
+    '''
+    exact median and variance of the quotient a/b of two readouts using
+    all well exposed pixels.
+    '''
+    A = _validquotient(a, b, rawminimum, rawsaturate, dtype)
+    return np.median(A), np.var(A)
+
+
+def _validquotient(a, b, rawminimum, rawsaturate, dtype='float64'):
+    '''
+    returns the 1d array of the quotients a/b of all pixels, which are
+    well exposed in both readouts.
+    '''
+    a = np.asarray(a, dtype=dtype)
+    b = np.asarray(b, dtype=dtype)
+    valid = (a >= rawminimum) & (a <= rawsaturate) & (b >= rawminimum) & (b <= rawsaturate)
+    valid &= (b != 0)
+    return a[valid] / b[valid]
+
+
+def _quotients(a, b, rawminimum, rawsaturate, dtype='float64', blocksize=None):
+    '''
+    yields the valid quotients a/b (see `_validquotient`) strip by strip,
+    so only blocksize rows of both readouts are held in memory at a time.
+    '''
+    for s in _strips(a.shape[0], blocksize):
+        yield _validquotient(a[s], b[s], rawminimum, rawsaturate, dtype)
+
+
+def _histrange(a, b, rawminimum, rawsaturate, dtype='float64', tolerance=1e-4,
+               maxbins=2**20):
+    '''
+    returns the lower edge lo and the number of bins of width tolerance of
+    a histogram of the quotient a/b. The quotient of two well exposed
+    pixels is bound to [rawminimum / rawsaturate, rawsaturate / rawminimum].
+    If this range needs more than maxbins bins (e.g. for rawminimum=0),
+    the histogram is restricted to maxbins bins centered at the median of a
+    subsample of about 2**16 pixels, so its memory stays bounded. Quotients
+    outside are counted in the first and last bin, which does not change the
+    median as long as it is within maxbins * tolerance / 2 of the median of
+    the subsample.
+    '''
+    lo = max(rawminimum, 0) / rawsaturate
+    hi = rawsaturate / max(rawminimum, 1)
+    nbins = int(np.ceil((hi - lo) / tolerance))
+    if nbins <= maxbins:
+        return lo, nbins
+    stride = max(int(np.sqrt(a.size / 2.**16)), 1)
+    q = _validquotient(a[::stride, ::stride], b[::stride, ::stride],
+                       rawminimum, rawsaturate, dtype)
+    center = np.median(q) if len(q) > 0 else 1.0
+    return min(max(center - maxbins * tolerance / 2, lo), hi - maxbins * tolerance), maxbins
+
+
+def _histmedian(hist, lo, tolerance):
+    '''
+    returns the median of the values counted in hist, a histogram with bins
+    of width tolerance starting at lo, interpolated within its bin.
+    '''
+    n = hist.sum()
+    cum = np.cumsum(hist)
+    i = np.searchsorted(cum, n / 2.0)
+    below = cum[i - 1] if i > 0 else 0
+    return lo + tolerance * (i + (n / 2.0 - below) / hist[i])
+
+
+def _ratiostats_histogram(a, b, rawminimum, rawsaturate, dtype='float64',
+                          tolerance=1e-4, blocksize=None, **kwargs):
+    '''
+    median and variance of the quotient a/b calculated in a single pass over
+    strips of blocksize rows. The median is taken from a histogram with
+    fixed bins of width tolerance, which is also its maximum error.
+    The variance is exact.
+    '''
+    lo, nbins = _histrange(a, b, rawminimum, rawsaturate, dtype, tolerance)
+    hist = np.zeros(nbins, dtype=np.int64)
+    n, s1, s2 = 0, 0.0, 0.0
+    for q in _quotients(a, b, rawminimum, rawsaturate, dtype, blocksize):
+        idx = np.clip(((q - lo) / tolerance).astype(np.intp), 0, nbins - 1)
+        hist += np.bincount(idx, minlength=nbins)
+        d = q - 1.0  # shifted to avoid cancellation in the variance
+        n += len(q)
+        s1 += np.sum(d, dtype=np.float64)
+        s2 += np.sum(d * d, dtype=np.float64)
+    if n == 0:
+        return np.nan, np.nan
+    return _histmedian(hist, lo, tolerance), s2 / n - (s1 / n) ** 2
+
+
+def _ratiostats_mad(a, b, rawminimum, rawsaturate, dtype='float64',
+                    tolerance=1e-4, blocksize=None, **kwargs):
+    '''
+    median and robust variance of the quotient a/b in two passes over strips
+    of blocksize rows. The median and the median absolute deviation (MAD)
+    from it are both taken from histograms with bins of width tolerance.
+    The variance is (1.4826 MAD)**2, which equals the variance of a normal
+    distribution, but is not affected by outliers.
+    '''
+    lo, nbins = _histrange(a, b, rawminimum, rawsaturate, dtype, tolerance)
+    hist = np.zeros(nbins, dtype=np.int64)
+    for q in _quotients(a, b, rawminimum, rawsaturate, dtype, blocksize):
+        idx = np.clip(((q - lo) / tolerance).astype(np.intp), 0, nbins - 1)
+        hist += np.bincount(idx, minlength=nbins)
+    if hist.sum() == 0:
+        return np.nan, np.nan
+    median = _histmedian(hist, lo, tolerance)
+    hist[...] = 0
+    for q in _quotients(a, b, rawminimum, rawsaturate, dtype, blocksize):
+        idx = np.clip((np.abs(q - median) / tolerance).astype(np.intp), 0, nbins - 1)
+        hist += np.bincount(idx, minlength=nbins)
+    mad = _histmedian(hist, 0.0, tolerance)
+    return median, (1.4826 * mad) ** 2
+
+
+def _ratiostats_clipped(a, b, rawminimum, rawsaturate, dtype='float64',
+                        tolerance=1e-4, blocksize=None, kappa=3.0, maxiter=10, **kwargs):
+    '''
+    sigma clipped mean and variance of the quotient a/b. Starting from the
+    median and MAD (see `_ratiostats_mad`), the mean and variance of all
+    quotients within kappa standard deviations are calculated in one pass
+    over strips of blocksize rows, until the mean changes by less than
+    tolerance or maxiter passes were made. The variance is corrected for the
+    clipped tails of a normal distribution.
+    '''
+    mean, var = _ratiostats_mad(a, b, rawminimum, rawsaturate, dtype=dtype,
+                                tolerance=tolerance, blocksize=blocksize)
+    # variance of a normal distribution truncated at kappa standard deviations
+    phi = math.exp(-kappa ** 2 / 2) / math.sqrt(2 * math.pi)
+    truncation = 1 - 2 * kappa * phi / math.erf(kappa / math.sqrt(2))
+    for _ in range(maxiter):
+        if not np.isfinite(mean):
+            break
+        width = kappa * math.sqrt(var)
+        n, s1, s2 = 0, 0.0, 0.0
+        for q in _quotients(a, b, rawminimum, rawsaturate, dtype, blocksize):
+            d = q[np.abs(q - mean) <= width] - mean
+            n += len(d)
+            s1 += np.sum(d, dtype=np.float64)
+            s2 += np.sum(d * d, dtype=np.float64)
+        if n == 0:
+            return np.nan, np.nan
+        last, mean = mean, mean + s1 / n
+        var = (s2 / n - (s1 / n) ** 2) / truncation
+        if abs(mean - last) <= tolerance:
+            break
+    return mean, var
+
+
+def _ratiostats_wls(a, b, rawminimum, rawsaturate, dtype='float64',
+                    blocksize=None, **kwargs):
+    '''
+    slope and variance of the quotient a/b from a weighted least squares fit
+    a = slope * b over all well exposed pixels in a single pass over strips
+    of blocksize rows. The variance of every pixel is assumed to be
+    proportional to its counts (shot noise), so the slope is sum(a) / sum(b)
+    and the variance of the quotient of a pixel with b counts is sigma**2 / b.
+    The returned variance is its average over all pixels.
+    '''
+    n, sa, sb, saab, sinvb = 0, 0.0, 0.0, 0.0, 0.0
+    for s in _strips(a.shape[0], blocksize):
+        ai = np.asarray(a[s], dtype=dtype)
+        bi = np.asarray(b[s], dtype=dtype)
+        valid = (ai >= rawminimum) & (ai <= rawsaturate) & \
+            (bi >= rawminimum) & (bi <= rawsaturate) & (bi > 0)
+        ai, bi = ai[valid], bi[valid]
+        n += len(ai)
+        sa += np.sum(ai, dtype=np.float64)
+        sb += np.sum(bi, dtype=np.float64)
+        saab += np.sum(ai * ai / bi, dtype=np.float64)
+        sinvb += np.sum(1.0 / bi, dtype=np.float64)
+    if n < 2:
+        return np.nan, np.nan
+    slope = sa / sb
+    # weighted sum of squared residuals sum((a - slope * b)**2 / b)
+    chi2 = max(saab - slope * sa, 0.0)
+    return slope, chi2 / (n - 1) * sinvb / n
+
+
+def _ratiostats_sample(a, b, rawminimum, rawsaturate, dtype='float64',
+                       tolerance=1e-4, samples=2**20, **kwargs):
+    '''
+    median and variance of the quotient a/b estimated from a regular grid of
+    about samples pixels. If the standard error of the median estimated from
+    this sample exceeds tolerance, the grid is refined once accordingly.
+    '''
+    rows, cols = a.shape
+    stride = max(int(np.sqrt(rows * cols / samples)), 1)
+    while True:
+        q = _validquotient(a[::stride, ::stride], b[::stride, ::stride],
+                           rawminimum, rawsaturate, dtype)
+        if len(q) == 0:
+            return np.nan, np.nan
+        median, var = np.median(q), np.var(q)
+        # standard error of the median of a normal distribution
+        err = 1.2533 * np.sqrt(var / len(q))
+        if err <= tolerance or stride == 1:
+            return median, var
+        stride = max(int(stride * tolerance / err), 1)
+
+
+_RATIOSTATS = {'exact': _ratiostats_exact,
+               'histogram': _ratiostats_histogram,
+               'sample': _ratiostats_sample,
+               'mad': _ratiostats_mad,
+               'clipped': _ratiostats_clipped,
+               'wls': _ratiostats_wls}
+
+
+def _poolmap(func, iterable, pool=None, threads=None):
+    '''
+    returns the list of func applied to every item of iterable. The calls are
+    distributed by pool.map if a pool is given, or by a temporary
+    ThreadPool with threads threads.
+    '''
+    if pool is not None:
+        return list(pool.map(func, iterable))
+    if threads is None or threads <= 1:
+        return list(map(func, iterable))
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(func, iterable)
+    finally:
+        pool.close()
+
+
+def _cachekey(files, *params):
+    '''
+    returns a fingerprint of the .inf and .img files given by their names
+    (without extension) based on their paths, sizes and modification times,
+    as well as the additional parameters params.
+    '''
+    h = hashlib.sha1()
+    for f in sorted(files):
+        for filename in (f + '.inf', f + '.img'):
+            st = os.stat(filename)
+            h.update(repr((os.path.abspath(filename), st.st_size, st.st_mtime)).encode())
+    h.update(repr(params).encode())
+    return h.hexdigest()
+
+
+def _cacheload(cachedir, key):
+    '''
+    returns the dict of arrays stored for key in cachedir or None,
+    if there is no such entry.
+    '''
+    filename = os.path.join(cachedir, key + '.npz')
+    try:
+        with open(filename, 'rb') as f, np.load(f) as data:
+            ret = dict(data)
+    except Exception:  # missing or damaged entries are assembled again
+        return None
+    try:
+        os.utime(filename, None)  # mark as recently used
+    except OSError:  # removed by another process meanwhile
+        pass
+    return ret
+
+
+def _cachesave(cachedir, key, maxsize, **arrays):
+    '''
+    stores arrays for key in cachedir. Afterwards the least recently used
+    entries are removed until all entries take at most maxsize bytes.
+    The cache is best effort: if the entry can not be written, a warning
+    is issued instead of raising.
+    '''
+    filename = os.path.join(cachedir, key + '.npz')
+    tmpname = '{}.{}.tmp'.format(filename, os.getpid())
+    try:
+        try:
+            os.makedirs(cachedir)
+        except OSError:  # exists, possibly created by a concurrent process
+            if not os.path.isdir(cachedir):
+                raise
+        with open(tmpname, 'wb') as f:
+            np.savez(f, **arrays)
+        _replace(tmpname, filename)  # atomic, concurrent readers never see partial files
+    except (IOError, OSError) as e:  # e.g. disk full or read-only
+        warnings.warn('could not write to the cache "{}": {}'.format(cachedir, e))
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+        return
+    # other processes may remove entries at any time
+    entries = []
+    for entry in glob.glob(os.path.join(cachedir, '*.npz')):
+        try:
+            st = os.stat(entry)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, entry))
+    total = 0
+    for _, size, entry in sorted(entries, reverse=True):
+        total += size
+        if total > maxsize:
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+
+
+def blockreduce(a, factor, func='mean'):
+    '''
+    returns the 2d array a reduced by the integer factor along both axes.
+    Each block of factor x factor pixels is replaced by its mean
+    (func='mean') or its maximum (func='max'). Rows and columns not filling
+    a complete block at the lower and right edges are dropped. a is
+    processed in strips, so memory maps are never loaded completely.
+    '''
+    reduce = {'mean': np.mean, 'max': np.max}[func]
+    factor = int(factor)
+    rows, cols = a.shape[0] // factor, a.shape[1] // factor
+    dtype = np.float64 if func == 'mean' else a.dtype.newbyteorder('=')
+    ret = np.empty((rows, cols), dtype=dtype)
+    # about 4 MPix of a per strip
+    for s in _strips(rows, max(2**22 // max(factor * factor * cols, 1), 1)):
+        block = a[s.start * factor:s.stop * factor, :cols * factor]
+        ret[s] = reduce(block.reshape(len(ret[s]), factor, cols, factor), axis=(1, 3))
+    return ret
+
+
+def _crosscorrelation(a, b, sigma=0.02):
+    '''
+    returns the shift (rows, cols) of the image b relative to the image a
+    of the same shape, i.e. b[y, x] = a[y - rows, x - cols], estimated from
+    the peak of their cross correlation calculated by FFT. The spectrum is
+    band passed by k**2 exp(-k**2 / (2 sigma**2)) (k in cycles per pixel):
+    the high pass removes the smooth background, which would pull the
+    peak towards zero, and the low pass the uncorrelated noise of the
+    readouts. The fractional part is interpolated by a parabola through
+    the correlation peak and its neighbours.
+    '''
+    window = np.outer(np.hanning(a.shape[0]), np.hanning(a.shape[1]))
+    fa = np.fft.rfft2((a - np.mean(a)) * window)
+    fb = np.fft.rfft2((b - np.mean(b)) * window)
+    k2 = np.fft.fftfreq(a.shape[0])[:, np.newaxis] ** 2 + \
+        np.fft.rfftfreq(a.shape[1])[np.newaxis, :] ** 2
+    corr = np.fft.irfft2(fb * np.conj(fa) * (k2 * np.exp(-k2 / (2 * sigma ** 2))), s=a.shape)
+    peak = np.unravel_index(np.argmax(corr), corr.shape)
+    shift = []
+    for axis, n in enumerate(corr.shape):
+        values = []
+        for k in (-1, 0, 1):
+            idx = list(peak)
+            idx[axis] = (idx[axis] + k) % n
+            values.append(corr[tuple(idx)])
+        curvature = values[0] - 2 * values[1] + values[2]
+        frac = 0.5 * (values[0] - values[2]) / curvature if curvature < 0 else 0.0
+        d = peak[axis] + frac
+        shift.append(d - n if d > n / 2. else d)
+    return np.array(shift)
+
+
+def _estimateshift(a, b, rawsaturate=65535.0, size=256):
+    '''
+    returns the shift (rows, cols) of the readout b relative to the readout
+    a (see `_crosscorrelation`). The shift is estimated coarsely on every
+    n-th pixel of both readouts, such that about size pixels along each axis
+    are left, and then refined on the window of size x size pixels with the
+    most structure at full resolution.
+
+    Saturated regions would bias the estimate, as they are larger in a than
+    in the fading readout b. The logarithmic counts of b are lower by about
+    a constant, so a is clipped at rawsaturate and b at rawsaturate minus
+    the median difference of both. Then the clipped regions of both have
+    the same shape.
+    '''
+    rows, cols = a.shape
+    factor = max(int(np.ceil(max(rows, cols) / float(size))), 1)
+    ra = np.array(a[::factor, ::factor], dtype=np.float64)
+    rb = np.array(b[::factor, ::factor], dtype=np.float64)
+    valid = (ra < rawsaturate) & (rb < rawsaturate)
+    level = rawsaturate - (np.median(ra[valid] - rb[valid]) if np.any(valid) else 0.0)
+    np.minimum(ra, rawsaturate, out=ra)
+    np.minimum(rb, level, out=rb)
+    coarse = np.zeros(2)
+    if factor > 1:
+        # features are factor times smaller in the reduced images
+        coarse = np.rint(factor * _crosscorrelation(ra, rb, sigma=min(0.02 * factor, 0.25)))
+    dy, dx = [int(d) for d in coarse]
+    h, w = min(size, rows - abs(dy)), min(size, cols - abs(dx))
+    # the window with the largest sum of absolute gradients
+    grad = np.abs(np.diff(ra, axis=0))[:, :-1] + np.abs(np.diff(ra, axis=1))[:-1]
+    integral = np.zeros((grad.shape[0] + 1, grad.shape[1] + 1))
+    np.cumsum(np.cumsum(grad, axis=0), axis=1, out=integral[1:, 1:])
+    bh, bw = min(max(h // factor, 1), grad.shape[0]), min(max(w // factor, 1), grad.shape[1])
+    boxes = integral[bh:, bw:] - integral[:-bh, bw:] - integral[bh:, :-bw] + integral[:-bh, :-bw]
+    y0, x0 = [factor * int(i) for i in np.unravel_index(np.argmax(boxes), boxes.shape)]
+    y0 = min(max(y0, -dy, 0), rows - h - max(dy, 0))
+    x0 = min(max(x0, -dx, 0), cols - w - max(dx, 0))
+    wa = np.minimum(a[y0:y0 + h, x0:x0 + w], rawsaturate).astype(np.float64)
+    wb = np.minimum(b[y0 + dy:y0 + dy + h, x0 + dx:x0 + dx + w], level).astype(np.float64)
+    return coarse + _crosscorrelation(wa, wb)
+
+
+def _overlap(shift, n):
+    '''
+    returns the slices (destination, source) of an axis of length n
+    shifted by the integer shift.
+    '''
+    return slice(max(shift, 0), n + min(shift, 0)), slice(max(-shift, 0), n - max(shift, 0))
+
+
+def _shiftimg(img, shift, dtype='float64', saturate=None):
+    '''
+    returns the image img shifted by shift (rows, cols) as a new array of
+    type dtype, i.e. ret[y, x] = img[y - rows, x - cols]. Fractional shifts
+    are interpolated bilinearly. Pixels without data from img are set to 0,
+    which excludes them from the scalefactors and the HDR image.
+    If saturate is given, interpolated pixels using a count above saturate
+    are set to the largest count of img, so they stay excluded as well.
+    '''
+    rows, cols = img.shape
+    ret = np.zeros(img.shape, dtype=dtype)
+    saturated = None
+    (iy, fy), (ix, fx) = [(int(np.floor(d)), d - np.floor(d)) for d in shift]
+    for sy, wy in ((iy, 1 - fy), (iy + 1, fy)):
+        for sx, wx in ((ix, 1 - fx), (ix + 1, fx)):
+            if wy * wx == 0:
+                continue
+            (dsty, srcy), (dstx, srcx) = _overlap(sy, rows), _overlap(sx, cols)
+            if wy * wx == 1:
+                ret[dsty, dstx] = img[srcy, srcx]
+            else:
+                ret[dsty, dstx] += wy * wx * np.asarray(img[srcy, srcx], dtype=dtype)
+                if saturate is not None:
+                    # the saturation mask is shifted along with the data
+                    saturated = np.zeros(img.shape, dtype=bool) if saturated is None \
+                        else saturated
+                    saturated[dsty, dstx] |= img[srcy, srcx] > saturate
+    if saturated is not None and saturated.any():
+        ret[saturated] = img.max()
+    # the edges, which are not covered by all interpolated pixels
+    ret[:max(iy + (fy > 0), 0)] = 0
+    ret[rows + min(iy, 0):] = 0
+    ret[:, :max(ix + (fx > 0), 0)] = 0
+    ret[:, cols + min(ix, 0):] = 0
+    return ret
 
 
 def read(*args, **kwargs):
@@ -52,10 +770,240 @@ def read(*args, **kwargs):
     Read the files. This is probably the function you are looking for.
 
     Forwards all arguments to `IPreader.__init__()`.
+
+    Additionally, roi may be a list of regions of interest. In this case a
+    list of IPreader objects is returned, one for every region. All of them
+    share the scalefactors, which are determined only once on the first
+    region or on calibration_roi, if given.
     '''
+    rois = kwargs.get('roi')
+    if isinstance(rois, list):
+        kwargs['roi'] = rois[0]
+        ip = IPreader(*args, **kwargs)
+        return [ip] + [ip.readroi(roi) for roi in rois[1:]]
     return IPreader(*args, **kwargs)
 
 
+def _platekey(inf, pattern):
+    '''
+    returns a key identifying the image plate of the readout inf (an
+    Infreader). See `findplates`. The first entry is the plate name.
+    '''
+    stem = re.sub(pattern, '', os.path.basename(inf.filename)[:-4])
+    return (stem, inf.R, inf.R2, inf.cols, inf.rows, inf.S, inf.L)
+
+
+_MONTHS = dict((m, i + 1) for i, m in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']))
+
+
+def _asctime(s):
+    '''
+    returns the seconds since the epoch of the time s written by
+    time.asctime in the C locale. Splitting the string is much faster than
+    time.strptime, which is used as fallback for any other format.
+    '''
+    try:
+        _, month, day, hms, year = s.split()
+        h, m, sec = hms.split(':')
+        return time.mktime((int(year), _MONTHS[month], int(day),
+                            int(h), int(m), int(sec), 0, 0, -1))
+    except (ValueError, KeyError):
+        return time.mktime(time.strptime(s.strip()))
+
+
+def _infrecord(filename):
+    '''
+    returns the row of the metadata index (see `scaninfs`) of the .inf file
+    filename or None, if it can not be parsed.
+    '''
+    try:
+        mtime = os.path.getmtime(filename)
+        with open(filename) as f:
+            inf = f.read().split('\n')
+        return (filename, '', int(inf[3]), int(inf[4]), int(inf[6]), int(inf[7]),
+                float(inf[8]), float(inf[9]), _asctime(inf[10]), mtime)
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+def scaninfs(files, pattern=r'[_-]\d+$', index=None, threads=8):
+    '''
+    reads the read out settings of many .inf files into a metadata index,
+    a numpy structured array with one row per readout sorted by readout
+    time. Its fields are filename, plate, R, R2, cols, rows, S, L, time
+    (seconds since the epoch) and mtime (of the .inf file). The plate is the
+    filename without directory, extension and the regular expression pattern
+    (see `findplates`). Files, which can not be parsed, are skipped.
+
+    files is a directory, which is scanned for .inf files, or a list of
+    .inf filenames. The files are read by threads threads.
+
+    If index is the filename of an .npy file, the index is loaded from and
+    saved to that file and only the .inf files whose mtime changed since
+    are parsed again. index=True stores the index as ".ipread-index.npy" in
+    the directory files.
+
+    The index allows fast queries, e.g. all readouts of plate "shot_12" with
+    R=50 and L=5 sorted by time:
+
+        t = scaninfs('data', index=True)
+        t[(t['plate'] == 'shot_12') & (t['R'] == 50) & (t['L'] == 5)]['filename']
+    '''
+    if isinstance(files, (list, tuple)):
+        if index is True:
+            raise ValueError('index=True requires files to be a directory.')
+    else:
+        if index is True:
+            index = os.path.join(files, '.ipread-index.npy')
+        files = glob.glob(os.path.join(files, '*.inf'))
+    known = {}
+    if index and os.path.isfile(index):
+        try:
+            for row in np.load(index).tolist():
+                known[row[0]] = row
+        except (IOError, OSError, ValueError):
+            warnings.warn('The metadata index {} is corrupt and rebuilt.'.format(index))
+
+    def record(filename):
+        row = known.get(filename)
+        try:
+            if row is not None and row[-1] == os.path.getmtime(filename):
+                return row
+        except OSError:
+            return None
+        return _infrecord(filename)
+
+    rows = [row for row in _poolmap(record, sorted(files), threads=threads)
+            if row is not None]
+    rows = [row[:1] + (re.sub(pattern, '', os.path.basename(row[0])[:-4]),) + row[2:]
+            for row in rows]
+    width = max([len(row[0]) for row in rows] + [1])
+    platewidth = max([len(row[1]) for row in rows] + [1])
+    dtype = [('filename', 'U{}'.format(width)), ('plate', 'U{}'.format(platewidth)),
+             ('R', 'i4'), ('R2', 'i4'), ('cols', 'i4'), ('rows', 'i4'),
+             ('S', 'f8'), ('L', 'f8'), ('time', 'f8'), ('mtime', 'f8')]
+    table = np.array(rows, dtype=dtype)
+    table = table[np.argsort(table['time'], kind='mergesort')]
+    changed = len(rows) != len(known) or any(known.get(row[0]) != row for row in rows)
+    if index and changed:
+        tmp = '{}.{}.tmp.npy'.format(index, os.getpid())
+        np.save(tmp, table)
+        _replace(tmp, index)
+    return table
+
+
+def findplates(directory, pattern=r'[_-]\d+$', index=None):
+    '''
+    Scans directory for .inf files and groups them into readout stacks,
+    one per image plate. Returns a list of lists of filenames (without
+    extension). Each stack is sorted by readout time and the stacks are
+    sorted by the time of their first readout.
+
+    Files belong to the same plate, if their names are equal after removing
+    the regular expression pattern (by default a trailing readout number
+    like "_2" or "-2") and if they were read with identical read out settings.
+
+    index is passed to `scaninfs`.
+    '''
+    table = scaninfs(directory, pattern=pattern, index=index)
+    stacks = collections.OrderedDict()
+    for row in table.tolist():
+        stacks.setdefault(row[1:8], []).append(row[0][:-4])
+    return list(stacks.values())
+
+
+def _uniquenames(names, times):
+    '''
+    returns the output names of plates named names, whose first readouts
+    were made at times (struct_time). Plates sharing a name (e.g. the same
+    filenames read with different settings) are told apart by the time
+    of their first readout and, if this is equal as well, by a counter.
+    '''
+    counts = collections.Counter(names)
+    ret = [name if counts[name] == 1 else
+           '{}_{}'.format(name, time.strftime('%Y%m%d-%H%M%S', t))
+           for name, t in zip(names, times)]
+    counts = collections.Counter(ret)
+    seen = collections.Counter()
+    for i, name in enumerate(ret):
+        if counts[name] > 1:
+            seen[name] += 1
+            ret[i] = '{}.{}'.format(name, seen[name])
+    return ret
+
+
+def _batchplate(args):
+    '''
+    assembles a single plate for `batch` and saves its PSL image.
+    Returns a dict summarizing the result.
+    '''
+    files, name, outdir, kwargs = args
+    summary = dict(plate=name, files=files, readouts=len(files))
+    try:
+        ip = IPreader(*[f + '.inf' for f in files], **kwargs)
+        summary['output'] = os.path.join(outdir, name + '.npy')
+        np.save(summary['output'], ip.psl)
+        summary['time'] = time.strftime('%Y-%m-%d %H:%M:%S', ip.time)
+        summary['scalefactors'] = ip.scalefactors
+        summary['scalefactorsstd'] = ip.scalefactorsstd
+    except Exception as e:
+        summary['error'] = '{}: {}'.format(type(e).__name__, e)
+    return summary
+
+
+def batch(directory, outdir=None, processes=None, pattern=r'[_-]\d+$', **kwargs):
+    '''
+    Assembles all image plates found in directory (see `findplates`) using a
+    pool of processes processes (defaults to the number of cores).
+    The PSL image of every plate is saved as "<plate>.npy" in outdir
+    (defaults to directory), where plates sharing a name are told apart by
+    the time of their first readout, and a table of all scalefactors and their
+    standard deviations is written to "summary.txt" in outdir.
+    Plates, which cannot be assembled, are listed there with the error.
+
+    kwargs are forwarded to `IPreader.__init__()`.
+    Returns the list of dicts summarizing each plate.
+    '''
+    outdir = directory if outdir is None else outdir
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    stacks = findplates(directory, pattern)
+    names = [re.sub(pattern, '', os.path.basename(files[0])) for files in stacks]
+    counts = collections.Counter(names)
+    times = [Infreader(files[0] + '.inf').time if counts[name] > 1 else None
+             for name, files in zip(names, stacks)]
+    tasks = [(files, name, outdir, kwargs)
+             for files, name in zip(stacks, _uniquenames(names, times))]
+    if processes == 1:
+        summaries = [_batchplate(task) for task in tasks]
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            summaries = pool.map(_batchplate, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    with open(os.path.join(outdir, 'summary.txt'), 'w') as f:
+        f.write('# plate\treadouts\ttime\tscalefactors\tscalefactorsstd\n')
+        for summary in summaries:
+            if 'error' in summary:
+                f.write('{plate}\t{readouts}\t# {error}\n'.format(**summary))
+                continue
+            f.write('{}\t{}\t{}\t{}\t{}\n'.format(
+                summary['plate'], summary['readouts'], summary['time'],
+                ','.join('{:.6g}'.format(x) for x in summary['scalefactors']),
+                ','.join('{:.6g}'.format(x) for x in summary['scalefactorsstd'])))
+    return summaries
+
+
+# (dtype, raw_dtype) of the precision policies of `IPreader`.
+# None uses dtype for the raw data.
+_PRECISIONS = {'double': ('float64', None),
+               'single': ('float32', 'uint16')}
+
+
 # ----- Classes -----
 class Infreader(object):
     '''
@@ -74,6 +1022,12 @@ class Infreader(object):
         self.name = os.path.basename(filename.strip('\n'))
         with open(filename) as f:
             inf = f.readlines()
+        self._parseinf(inf)
+
+    def _parseinf(self, inf):
+        '''
+        sets the read out settings from the lines inf of an .inf file.
+        '''
         self.infstring = inf
         self.R = int(inf[3])
         self.R2 = int(inf[4])
@@ -85,12 +1039,29 @@ class Infreader(object):
         if self.R != self.R2:
             warnings.warn('The Pixels of the IP picture are no squares.')
 
-    def topsl(self, c):
+    def topsl(self, c, out=None, lut=None):
         """
         returns the PSL value corresponding to the count number c at the
         readout settings defined by this Infreader object.
+
+        uint8 and uint16 counts (like single readouts memory mapped by
+        `readimg`) are converted by a lookup in a cached table of all 65536
+        possible values. lut=True forces this for other data holding
+        integer counts (like single readouts read by `readimg`), which are
+        clipped to [0, 65535]. lut=False always evaluates the conversion
+        formula, as is done for all other data, including python ints and
+        wider integer types, which may exceed the table.
         """
-        return cnttopsl(c, self.R, self.S, self.L)
+        c = np.asanyarray(c)
+        if lut is None:
+            lut = c.dtype.kind == 'u' and c.dtype.itemsize <= 2
+        if not lut:
+            return cnttopsl(c, self.R, self.S, self.L, out=out)
+        table = _psllut(self.R, self.S, self.L,
+                        dtype=np.float64 if out is None else out.dtype)
+        if not (c.dtype.kind == 'u' and c.dtype.itemsize <= 2):
+            c = np.clip(np.rint(c), 0, 65535).astype(np.uint16)
+        return np.take(table, c, out=out)
 
     def __str__(self):
         return '<"' + self.name + '" R:' + str(self.R) + ' cols:' + \
@@ -130,60 +1101,287 @@ class IPreader(Infreader):
     - self.scalefactorsstd - list of floats of standard deviation
       of scalefactors
     - self.psl - the high dynamic range image created by combining
-      the images in self.psls using self.scalefactors
+      the images in self.psls using self.scalefactors. It is calculated
+      on first access only and cached afterwards. The cached array is
+      read-only, `getpsl` returns a writable copy.
+    - self.count - the number of readouts contributing to each pixel
+      of the HDR image.
+    - self.raw_var - the variance of each pixel of self.raw_hdr, if sigma
+      is True, else None.
+    - self.pslsigma - the standard deviation of each pixel of self.psl,
+      if sigma is True (see `getpslsigma`). Read-only like self.psl.
+
+    Readouts made later can be added by `add_readout`.
+
+    Optional kwargs:
+
+    - raw_underexposed, raw_overexposed - raw count thresholds. Only pixels
+      in between are used for the scalefactor calculation and pixels above
+      raw_overexposed are excluded from the HDR assembly.
+    - memmap - if True, the readouts in self.raw are kept as read-only
+      uint16 memory maps of the .img files (see `readimg`) instead of being
+      loaded into memory. Defaults to False.
+    - dtype - the floating point type used for the calculations and for
+      self.raw_hdr. Use np.float32 to halve the memory needed.
+      Defaults to np.float64.
+    - raw_dtype - the type of the readouts in self.raw, if they are not
+      memory mapped. The raw counts are integers below 2**16, so np.uint16
+      stores them exactly with a quarter of the memory of float64.
+      Defaults to dtype.
+    - precision - 'double' (default) or 'single'. 'single' changes the
+      defaults of dtype and psl_dtype to np.float32 and of raw_dtype to
+      np.uint16, which needs about a third of the memory. Compared to
+      'double', the relative error of raw_hdr is below
+      (readouts + 1) * 2**-24 (about 1e-7 per readout), the PSL conversion
+      amplifies it by L * ln(10) * raw_hdr / 65536, so the relative error
+      of psl stays below 1e-5 for L <= 5 and a few readouts. The
+      scalefactors differ by less than 1e-6, which is far below their
+      standard deviations.
+    - blocksize - number of rows per strip. If given, the HDR image is
+      assembled strip by strip, so only a few strips of each readout are
+      held in memory at any time. Defaults to None (whole image at once).
+    - out - where to write self.raw_hdr to. Either an array of shape
+      (rows, cols) or a filename, which will be created as memory mapped
+      `.npy` file. Defaults to None (a new array in memory).
+    - sf_method - how the median and variance of the quotient of two
+      consecutive readouts is estimated for the scalefactors:
+      'exact' uses all pixels (default without blocksize), but converts two
+      whole readouts to dtype at once. 'histogram' (default with blocksize)
+      needs a single pass over the images in strips of blocksize rows and
+      gives the median within sf_tolerance, 'sample'
+      uses a regular subsample of the pixels, such that the standard error
+      of the median is about sf_tolerance. The robust methods 'mad' (median
+      and median absolute deviation), 'clipped' (sigma clipped mean) and
+      'wls' (weighted least squares fit of a readout against the next one)
+      work strip by strip with bounded memory and are not affected by
+      outliers close to raw_underexposed and raw_overexposed. sf_method
+      may also be a callable with the signature of these methods, i.e.
+      sf_method(a, b, rawminimum, rawsaturate, dtype=, tolerance=,
+      blocksize=), returning the ratio of the readouts a and b and the
+      variance of the ratio of single pixels. Such a callable is identified
+      in the cache by its module and qualified name, so lambdas and
+      partials are not cached.
+    - sf_tolerance - see sf_method. Defaults to 1e-4.
+    - threads - number of threads used to read the files and to compute the
+      statistics of consecutive readouts concurrently. Defaults to None
+      (everything is done sequentially).
+    - pool - alternatively to threads, any object providing a `map` method
+      (for example a `multiprocessing.pool.ThreadPool` or a
+      `concurrent.futures.ThreadPoolExecutor`) to use for the same purpose.
+    - cache - directory to cache assembled images in, or True to use
+      "~/.cache/ipread". If the same files (identified by path, size and
+      modification time) are read again with the same settings, raw_hdr and
+      the scalefactors are loaded from the cache and self.raw holds memory
+      maps of the .img files. Defaults to None (no caching).
+    - psl_dtype - the type of self.psl. Defaults to dtype. Use np.float32
+      to halve the memory needed for the PSL image.
+    - cachesize - the cache size in bytes. The least recently used entries
+      are removed if it is exceeded. Defaults to 4 GiB.
+    - roi - region of interest as tuple (rowslice, colslice), for example
+      `np.s_[1000:1200, :]`. Only this window of the files is read and
+      assembled, so self.raw and self.raw_hdr have its shape. Defaults to
+      None (the full image).
+    - calibration_roi - the region (in the same coordinates as roi) used to
+      determine the scalefactors. Defaults to None (use roi).
+    - profile - if True, the wall time, the bytes read and the peak memory
+      allocated (python 3 only) of every stage ('infreader', 'readimg',
+      'ratiostats', 'assemble', 'psl') and of every readout within a stage
+      (e.g. 'readimg[2]') are recorded in the dict self.timings. If a
+      callable is given, it is also called as profile(stage, record)
+      after every stage. Defaults to False.
+    - sigma - if True, the variance of every pixel of the HDR image is
+      accumulated in self.raw_var in the same pass as raw_hdr. It includes
+      the noise raw_noise of the raw counts, the variance of the
+      scalefactors and only the readouts, which are not saturated at
+      this pixel. Defaults to False.
+    - align - if True, the shift of every readout relative to the previous
+      one is estimated by FFT cross correlation (see `_estimateshift`) and
+      the readouts are shifted onto the first one before the scalefactors
+      are determined and the HDR image is assembled. Subpixel shifts are
+      interpolated bilinearly, which needs the shifted readouts in memory.
+      Interpolated pixels next to saturated ones count as saturated.
+      The shifts are stored in self.shifts. Defaults to False.
+    - raw_noise - the standard deviation of the counts of a single readout.
+      For the logarithmic scale of the scanner a constant relative noise
+      of the PSL signal is a constant noise of the counts. Defaults to 1.
+
+    For plates larger than the available memory use blocksize together with
+    memmap=True (which is the default if blocksize is given) and out. The
+    scalefactors must then be determined strip by strip as well, which is
+    why sf_method defaults to 'histogram' if blocksize is given. 'exact' and
+    'sample' (which may refine its subsample to all pixels) are not bounded
+    in memory.
     '''
 
     def __init__(self, *args, **kwargs):
         raw_underexposed = kwargs.pop('raw_underexposed', 42000.0)
         raw_overexposed = kwargs.pop('raw_overexposed', 65525.0)
+        precision = kwargs.pop('precision', 'double')
+        if precision not in _PRECISIONS:
+            raise ValueError('unknown precision "{}". Use one of {}.'
+                             .format(precision, sorted(_PRECISIONS)))
+        dtype, raw_dtype = _PRECISIONS[precision]
+        self.dtype = np.dtype(kwargs.pop('dtype', dtype))
+        self.raw_dtype = np.dtype(kwargs.pop('raw_dtype', raw_dtype or self.dtype))
+        self.blocksize = kwargs.pop('blocksize', None)
+        memmap = kwargs.pop('memmap', self.blocksize is not None)
+        out = kwargs.pop('out', None)
+        self.sf_method = kwargs.pop('sf_method',
+                                    'exact' if self.blocksize is None else 'histogram')
+        self.sf_tolerance = kwargs.pop('sf_tolerance', 1e-4)
+        pool = kwargs.pop('pool', None)
+        threads = kwargs.pop('threads', None)
+        cache = kwargs.pop('cache', None)
+        cachesize = kwargs.pop('cachesize', 2**32)
+        self.psl_dtype = np.dtype(kwargs.pop('psl_dtype', self.dtype))
+        self.roi = kwargs.pop('roi', None)
+        self.calibration_roi = kwargs.pop('calibration_roi', None)
+        self.memmap = memmap
+        self.profile = kwargs.pop('profile', False)
+        self.sigma = kwargs.pop('sigma', False)
+        self.raw_noise = kwargs.pop('raw_noise', 1.0)
+        self.raw_var = None
+        self.align = kwargs.pop('align', False)
+        self.timings = collections.OrderedDict()
+        if not callable(self.sf_method) and self.sf_method not in _RATIOSTATS:
+            raise ValueError('unknown sf_method "{}". Use one of {}.'
+                             .format(self.sf_method, sorted(_RATIOSTATS)))
         if len(kwargs) > 0:  # unused kwargs left
             raise TypeError('unknown kwargs given: {:}'.format(kwargs))
-        if len(args) == 1:
-            self.files = glob.glob(args[0])  # this always returns a list
-        elif len(args) > 1:  # List of filenames given
-            self.files = args
-
-        def removeext(s):
-            return s[:-4] if s.endswith('.img') or s.endswith('.inf') else s
-        self.files = [removeext(f) for f in self.files]
-        # make list unique, so every file is only read once if
-        # name* results in a list containing .img and .inf files.
-        self.files = list(set(self.files))
-        infs = [Infreader('{}.inf'.format(f)) for f in self.files]
-        infs.sort(key=lambda s: s.time)
-        self.files = [inf.filename[:-4] for inf in infs]
-
-        Infreader.__init__(self, self.files[0] + '.inf')
-        for f in self.files:
-            # Ensure equal readout setting (only sensitivity S may differ)
-            other = Infreader(f + '.inf')
-            settings = ['R', 'R2', 'cols', 'rows', 'L', 'S']
-            if not all([getattr(self, s) == getattr(other, s) for s in settings]):
-                raise Exception('File "{}" was read using different '
-                                'read out settings than "{}". Refusing HDR '
-                                'assembly.'.format(other, Infreader.__str__(self)))
-
-        self.raw = [readimg(datei, self.rows, self.cols)
-                    for datei in self.files]
-        # Combine psl pictures to a single HDR picture
+        self.files = _expandfiles(args)
         self.rawsaturate = raw_overexposed
         self.rawminimum = raw_underexposed
+        if cache and '<' in self._sfname():
+            warnings.warn('sf_method {} can not be identified by its name, so the cache is '
+                          'not used.'.format(self._sfname()))
+            cache = None
+        if cache:
+            cache = os.path.join(os.path.expanduser('~'), '.cache', 'ipread') \
+                if cache is True else cache
+            cachekey = _cachekey(self.files, self.rawminimum, self.rawsaturate,
+                                 self.dtype.str, self._sfname(), self.sf_tolerance,
+                                 self.roi, self.calibration_roi,
+                                 self.raw_noise if self.sigma else None, self.align)
+            cached = _cacheload(cache, cachekey)
+            if cached is not None:
+                self._restore(cached, out=out)
+                return
+
+        with self._stage('infreader'):
+            infs = _poolmap(Infreader, ['{}.inf'.format(f) for f in self.files],
+                            pool=pool, threads=threads)
+            infs.sort(key=lambda s: s.time)
+            self.files = [inf.filename[:-4] for inf in infs]
+
+            # reuse the parsed .inf files instead of reading them again
+            self.filename, self.name = infs[0].filename, infs[0].name
+            self._parseinf(infs[0].infstring)
+            for inf in infs[1:]:
+                self._checksettings(inf)
+
+        self._normalizerois()
+        with self._stage('readimg') as stats:
+            # fail before anything is read and let the OS read ahead
+            for f in self.files:
+                filename = _imgfile(f, self.rows, self.cols)
+                if not memmap:
+                    _fadvise(filename, 'POSIX_FADV_WILLNEED')
+            self.raw = _poolmap(self._readraw, self.files, pool=pool, threads=threads)
+            stats['bytes'] = 0 if memmap else sum(2 * img.size for img in self.raw)
+        if self.calibration_roi is None:
+            self._calibrationraw = self.raw
+        else:
+            self._calibrationraw = [readimg(f, self.rows, self.cols, memmap=True,
+                                            roi=self.calibration_roi) for f in self.files]
+        self.shifts = np.zeros((len(self.raw), 2))
+        if self.align:
+            with self._stage('align'):
+                shifts = _poolmap(self._readoutshift, range(len(self.raw) - 1),
+                                  pool=pool, threads=threads)
+                self.shifts[1:] = np.cumsum(shifts, axis=0)
+                self._alignraw(self.raw)
+                if self._calibrationraw is not self.raw:
+                    self._alignraw(self._calibrationraw)
+        # Combine psl pictures to a single HDR picture
+        # the statistics of all pairs are independent and only chained afterwards
+        with self._stage('ratiostats'):
+            ratiostats = _poolmap(self._ratiostats, range(len(self.raw) - 1),
+                                  pool=pool, threads=threads)
         self.scalefactors = np.array([1.0])
         self.scalefactorsstd = np.array([0.0])
-        sfvar = np.array([0.0])
-        for n in range(1, len(self.raw)):
-            A = self.getimgquotient(n - 1)
-            meand = np.median(A[np.isfinite(A)])
-            varianzd = np.var(A[np.isfinite(A)])
-            mean = self.scalefactors[n - 1] * meand
-            varianz = self.scalefactors[n - 1] ** 2 * varianzd + \
-                sfvar[n - 1] * meand ** 2 + \
-                varianzd ** 2 * sfvar[n - 1] ** 2
-            self.scalefactors = np.append(self.scalefactors, mean)
-            sfvar = np.append(sfvar, varianz)
-        self.scalefactorsstd = np.sqrt(sfvar)
-
-        # check consistency
+        self._sfvar = np.array([0.0])
+        for meand, varianzd in ratiostats:
+            self._appendscalefactor(meand, varianzd)
+        self._checkscalefactors()
+
+        with self._stage('assemble'):
+            self.assemble(out=out)
+        if cache:
+            _cachesave(cache, cachekey, cachesize, **self._state())
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        '''
+        records the wall time and the peak memory allocated (python 3 only)
+        in the stage name to self.timings, if profiling is enabled. The
+        body may add the bytes read to the yielded dict as 'bytes'.
+        Stages with the same name are summed up.
+        '''
+        stats = dict(time=0.0, bytes=0, peak=None)
+        if not self.profile:
+            yield stats
+            return
+        trace = tracemalloc is not None and not tracemalloc.is_tracing()
+        if trace:
+            tracemalloc.start()
+        t = time.time()
+        try:
+            yield stats
+        finally:
+            if trace:
+                stats['peak'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            record = self.timings.setdefault(name, dict(time=0.0, bytes=0, peak=None))
+            record['time'] += time.time() - t
+            record['bytes'] += stats['bytes']
+            if stats['peak'] is not None:
+                record['peak'] = max(record['peak'] or 0, stats['peak'])
+            if callable(self.profile):
+                self.profile(name, record)
+
+    def _readraw(self, filename):
+        # a readout added by add_readout is read before it is in self.files
+        n = self.files.index(filename) if filename in self.files else len(self.files)
+        with self._stage('readimg[{}]'.format(n)) as stats:
+            img = readimg(filename, self.rows, self.cols, dtype=self.raw_dtype,
+                          memmap=self.memmap, roi=self.roi)
+            # memory mapped data is read later, when it is used
+            stats['bytes'] = 0 if self.memmap else 2 * img.size
+        return img
+
+    def _checksettings(self, other):
+        # Ensure equal readout setting (only sensitivity S may differ)
+        settings = ['R', 'R2', 'cols', 'rows', 'L', 'S']
+        if not all([getattr(self, s) == getattr(other, s) for s in settings]):
+            raise Exception('File "{}" was read using different '
+                            'read out settings than "{}". Refusing HDR '
+                            'assembly.'.format(other, Infreader.__str__(self)))
+
+    def _appendscalefactor(self, meand, varianzd):
+        '''
+        appends the scalefactor of the next readout, if the quotient of the
+        last readout and the next one has the median meand and the
+        variance varianzd.
+        '''
+        mean = self.scalefactors[-1] * meand
+        varianz = self.scalefactors[-1] ** 2 * varianzd + \
+            self._sfvar[-1] * meand ** 2 + \
+            varianzd ** 2 * self._sfvar[-1] ** 2
+        self.scalefactors = np.append(self.scalefactors, mean)
+        self._sfvar = np.append(self._sfvar, varianz)
+        self.scalefactorsstd = np.sqrt(self._sfvar)
+
+    def _checkscalefactors(self):
         if not all(self.scalefactors == sorted(self.scalefactors)):
             warnings.warn('IP Files were not given is ascending read out '
                           'order! '
@@ -196,31 +1394,352 @@ class IPreader(Infreader):
                           '(in other words: there is at least one'
                           'scalefactor < 1).')
 
-        # Assemble HDR Image in raw scale
-        self.raw_hdr = np.zeros(self.raw[0].shape)
-        count = np.zeros(self.raw[0].shape)
-        for n in range(len(self.raw)):
-            if np.isnan(self.scalefactors[n]):
-                continue
-            picn = copy.copy(self.raw[n])
-            picn[picn > self.rawsaturate] = 0
-            self.raw_hdr += self.scalefactors[n] * picn
-            count += (picn > 0)
-        count[count == 0] = 1  # prevents dividing by zero
-        self.raw_hdr /= count
+    def assemble(self, out=None):
+        '''
+        (re)assembles the HDR image self.raw_hdr in raw scale from the
+        readouts in self.raw using self.scalefactors. See `IPreader` for out.
+        self.count holds the number of readouts contributing to each pixel.
+        '''
+        shape = self.raw[0].shape
+        self.raw_hdr = _outarray(out, shape, self.dtype)
+        self.count = np.zeros(shape, dtype=np.uint8 if len(self.raw) < 256 else np.uint16)
+        self.raw_var = np.zeros(shape, dtype=self.dtype) if self.sigma else None
+        self._accumulate(range(len(self.raw)))
+
+    def add_readout(self, filename):
+        '''
+        adds the next readout of the same image plate given by filename
+        (with '.img' or '.inf' or no extension) as it comes off the scanner.
+        Only the new readout and the previous one are needed to extend
+        self.scalefactors and to update self.raw_hdr and self.count,
+        so the stack does not have to be assembled again.
+        '''
+        filename = _removeext(filename)
+        self._checksettings(Infreader(filename + '.inf'))
+        # read everything first, so a failure (e.g. a readout still being
+        # written) leaves all lists unchanged
+        raw = self._readraw(filename)
+        if self._calibrationraw is not self.raw:
+            calibrationraw = readimg(filename, self.rows, self.cols, memmap=True,
+                                     roi=self.calibration_roi)
+            self._calibrationraw.append(calibrationraw)
+        self.files.append(filename)
+        self.raw.append(raw)
+        n = len(self.raw) - 1
+        # the previous readout is aligned already
+        shift = self._readoutshift(n - 1) if self.align else np.zeros(2)
+        self.shifts = np.vstack([self.shifts, shift])
+        self._alignraw(self.raw, [n])
+        if self._calibrationraw is not self.raw:
+            self._alignraw(self._calibrationraw, [n])
+        if len(self.raw) > np.iinfo(self.count.dtype).max:
+            self.count = self.count.astype(np.uint16)
+        self._appendscalefactor(*self._ratiostats(n - 1))
+        self._checkscalefactors()
+        with self._stage('add_readout'):
+            self._accumulate([n], incremental=True)
+
+    def _readoutshift(self, n):
+        '''
+        returns the shift of readout n + 1 relative to readout n.
+        '''
+        with self._stage('align[{}]'.format(n + 1)):
+            return _estimateshift(self.raw[n], self.raw[n + 1], self.rawsaturate)
+
+    def _alignraw(self, raws, readouts=None):
+        '''
+        shifts the readouts with the indices readouts (defaults to all) in
+        the list raws by -self.shifts onto the first readout.
+        '''
+        for n in range(len(raws)) if readouts is None else readouts:
+            # shifts below the accuracy of the estimate are not interpolated
+            shift = np.where(np.abs(self.shifts[n]) < 0.1, 0.0, -self.shifts[n])
+            if np.any(shift):
+                integer = np.all(shift == np.rint(shift))
+                raws[n] = _shiftimg(raws[n], shift,
+                                    dtype=self.raw_dtype if integer else self.dtype,
+                                    saturate=self.rawsaturate)
+
+    def _accumulate(self, readouts, incremental=False):
+        '''
+        adds the readouts with the indices readouts to self.raw_hdr,
+        self.count and self.raw_var. If incremental is True, raw_hdr already
+        holds the average of other readouts.
+        '''
+        rows, cols = self.raw_hdr.shape
+        blocksize = rows if self.blocksize is None else min(self.blocksize, rows)
+        # buffers reused for all strips and readouts, so no temporaries are created
+        shape = (blocksize, cols)
+        tmpbuf = np.empty(shape, dtype=self.dtype)
+        validbuf = np.empty(shape, dtype=bool)
+        posbuf = np.empty(shape, dtype=bool)
+        picbuf = None
+        varbuf = None if self.raw_var is None else np.empty(shape, dtype=self.dtype)
+        for s in _strips(rows, blocksize):
+            hdr = self.raw_hdr[s]  # view, accumulated in place
+            count = self.count[s]
+            m = len(hdr)
+            tmp, valid, pos = tmpbuf[:m], validbuf[:m], posbuf[:m]
+            if incremental:
+                np.multiply(hdr, count, out=hdr)  # the sum of all readouts so far
+            if varbuf is not None:
+                var = self.raw_var[s]
+                if incremental:  # the variance of the sum
+                    np.multiply(var, count, out=var)
+                    np.multiply(var, count, out=var)
+            for n in readouts:
+                if np.isnan(self.scalefactors[n]):
+                    continue
+                with self._stage('assemble[{}]'.format(n)):
+                    picn = self.raw[n][s]
+                    if picn.dtype != self.dtype:  # e.g. memory mapped raw data
+                        picbuf = np.empty(shape, dtype=self.dtype) if picbuf is None else picbuf
+                        np.copyto(picbuf[:m], picn)
+                        picn = picbuf[:m]
+                    # saturated pixels do not contribute to the weighted sum and count
+                    np.less_equal(picn, self.rawsaturate, out=valid)
+                    np.multiply(picn, self.scalefactors[n], out=tmp, casting='same_kind')
+                    np.add(hdr, tmp, out=hdr, where=valid)
+                    np.greater(picn, 0, out=pos)
+                    np.logical_and(valid, pos, out=valid)
+                    np.add(count, valid, out=count)
+                    if varbuf is not None:
+                        # only readouts counted in count contribute to the variance
+                        # var(f c) = c**2 var(f) + f**2 var(c)
+                        vtmp = varbuf[:m]
+                        np.multiply(picn, picn, out=vtmp)
+                        np.multiply(vtmp, self._sfvar[n], out=vtmp)
+                        np.add(vtmp, (self.scalefactors[n] * self.raw_noise) ** 2, out=vtmp)
+                        np.add(var, vtmp, out=var, where=valid)
+            np.maximum(count, 1, out=tmp)  # prevents dividing by zero
+            np.divide(hdr, tmp, out=hdr)
+            if varbuf is not None:
+                np.divide(var, tmp, out=var)
+                np.divide(var, tmp, out=var)
+        if isinstance(self.raw_hdr, np.memmap):
+            self.raw_hdr.flush()
+        self.clearpsl()
+
+    def _normalizerois(self):
+        if self.roi is not None:
+            self.roi = _roislices(self.roi, self.rows, self.cols)
+        if self.calibration_roi is not None:
+            self.calibration_roi = _roislices(self.calibration_roi, self.rows, self.cols)
+
+    def readroi(self, roi, out=None):
+        '''
+        returns a new IPreader object holding the region of interest roi
+        (see `IPreader`) of the same files. The scalefactors of this object
+        are used, so only roi is read and assembled.
+        '''
+        ret = copy.copy(self)
+        ret.clearpsl()
+        # add_readout on ret must not extend the lists of this object and
+        # keeps calibrating on the region the scalefactors come from
+        ret.files = list(self.files)
+        ret.timings = collections.OrderedDict(self.timings)
+        ret._calibrationraw = list(self._calibrationraw)
+        if self.calibration_roi is None:
+            ret.calibration_roi = self.roi if self.roi is not None \
+                else _roislices((slice(None), slice(None)), self.rows, self.cols)
+        ret.roi = _roislices(roi, self.rows, self.cols)
+        # aligning needs the pixels the readouts are shifted in from, so
+        # a margin around roi is read, aligned and cut off afterwards
+        margin = int(np.ceil(np.abs(self.shifts).max())) if len(self.shifts) else 0
+        outer = tuple(slice(max(s.start - margin, 0), min(max(s.stop, s.start) + margin, n))
+                      for s, n in zip(ret.roi, (self.rows, self.cols)))
+        inner = tuple(slice(s.start - o.start, max(s.stop, s.start) - o.start, s.step)
+                      for s, o in zip(ret.roi, outer))
+        ret.raw = [readimg(f, self.rows, self.cols, dtype=self.raw_dtype, memmap=self.memmap,
+                           roi=outer if margin else ret.roi) for f in self.files]
+        if margin:
+            ret._alignraw(ret.raw)
+            ret.raw = [raw[inner] for raw in ret.raw]
+        ret.assemble(out=out)
+        return ret
+
+    def _state(self):
+        '''
+        returns a dict of arrays holding the result of the HDR assembly.
+        '''
+        state = dict(files=np.array(self.files), infstring=np.array(self.infstring),
+                     raw_hdr=self.raw_hdr, count=self.count, scalefactors=self.scalefactors,
+                     scalefactorsstd=self.scalefactorsstd,
+                     rawminimum=self.rawminimum, rawsaturate=self.rawsaturate,
+                     shifts=self.shifts)
+        if self.raw_var is not None:
+            state['raw_var'] = self.raw_var
+        return state
+
+    def _restore(self, state, out=None):
+        '''
+        restores the result of a HDR assembly from state as returned by
+        `_state`. The readouts in self.raw are memory mapped, if present.
+        '''
+        self.files = [str(f) for f in state['files']]
+        self.filename = self.files[0] + '.inf'
+        self.name = os.path.basename(self.filename)
+        self._parseinf([str(line) for line in state['infstring']])
+        self._normalizerois()
+        self.rawminimum = float(state['rawminimum'])
+        self.rawsaturate = float(state['rawsaturate'])
+        self.scalefactors = np.asarray(state['scalefactors'])
+        self.scalefactorsstd = np.asarray(state['scalefactorsstd'])
+        self._sfvar = self.scalefactorsstd ** 2
+        self.count = np.asarray(state['count'])
+        self.raw_var = np.asarray(state['raw_var']) if 'raw_var' in state else None
+        self.sigma = self.raw_var is not None
+        self.raw_hdr = np.asarray(state['raw_hdr'], dtype=self.dtype)
+        if out is not None:
+            self.raw_hdr = _outarray(out, self.raw_hdr.shape, self.dtype)
+            self.raw_hdr[...] = state['raw_hdr']
+        self.raw = [readimg(f, self.rows, self.cols, memmap=True, roi=self.roi)
+                    for f in self.files if os.path.exists(f + '.img')]
+        self.shifts = np.asarray(state['shifts']) if 'shifts' in state \
+            else np.zeros((len(self.files), 2))
+        if len(self.raw) == len(self.files):
+            self._alignraw(self.raw)
+        self._calibrationraw = self.raw
+
+    def save(self, filename, dtype=None, chunks=(256, 256), compression='gzip'):
+        '''
+        saves the assembled image to the HDF5 file filename (needs h5py).
+        raw_hdr (converted to dtype, e.g. np.float32, if given) and count
+        are stored chunked and compressed, so regions can be read without
+        reading the whole file (see `load`). The scalefactors, their
+        standard deviations, the contents of the .inf file and raw_var
+        (if present) are stored as well.
+        '''
+        import h5py
+        dtype = self.raw_hdr.dtype if dtype is None else np.dtype(dtype)
+        rows, cols = self.raw_hdr.shape
+        chunks = (min(chunks[0], rows), min(chunks[1], cols))
+        with h5py.File(filename, 'w') as f:
+            datasets = [('raw_hdr', self.raw_hdr, dtype), ('count', self.count, self.count.dtype)]
+            if self.raw_var is not None:
+                datasets.append(('raw_var', self.raw_var, dtype))
+            for name, data, dt in datasets:
+                dset = f.create_dataset(name, (rows, cols), dtype=dt, chunks=chunks,
+                                        compression=compression, shuffle=True)
+                for s in _strips(rows, chunks[0]):  # bounded memory for memory maps
+                    dset[s] = data[s]
+            f['scalefactors'] = self.scalefactors
+            f['scalefactorsstd'] = self.scalefactorsstd
+            f['shifts'] = self.shifts
+            f.attrs['align'] = self.align
+            f.attrs['infstring'] = ''.join(self.infstring)
+            f.attrs['files'] = '\n'.join(self.files)
+            f.attrs['rawminimum'] = self.rawminimum
+            f.attrs['rawsaturate'] = self.rawsaturate
+            f.attrs['sf_method'] = self._sfname()
+            f.attrs['sf_tolerance'] = self.sf_tolerance
+            f.attrs['raw_noise'] = self.raw_noise
+            if self.roi is not None:
+                f.attrs['roi'] = [x for s in self.roi for x in (s.start, s.stop, s.step)]
+
+    @classmethod
+    def load(cls, filename, roi=None):
+        '''
+        returns the IPreader object saved to filename by `save`.
+        If roi is given, only this region (relative to the saved image) of
+        raw_hdr and count is read. self.raw holds memory maps of the
+        readouts, if the original files still exist.
+        '''
+        import h5py
+        with h5py.File(filename, 'r') as f:
+            rows, cols = f['raw_hdr'].shape
+            sel = _roislices((slice(None), slice(None)) if roi is None else roi, rows, cols)
+            state = dict(raw_hdr=f['raw_hdr'][sel], count=f['count'][sel],
+                         scalefactors=f['scalefactors'][()],
+                         scalefactorsstd=f['scalefactorsstd'][()],
+                         infstring=str(f.attrs['infstring']).splitlines(True),
+                         files=str(f.attrs['files']).split('\n'),
+                         rawminimum=f.attrs['rawminimum'], rawsaturate=f.attrs['rawsaturate'])
+            if 'raw_var' in f:
+                state['raw_var'] = f['raw_var'][sel]
+            if 'shifts' in f:
+                state['shifts'] = f['shifts'][()]
+            attrs = dict(f.attrs)
+        ip = cls.__new__(cls)
+        ip.dtype = state['raw_hdr'].dtype
+        ip.raw_dtype = ip.dtype
+        ip.psl_dtype = ip.dtype
+        ip.blocksize = None
+        ip.memmap = True
+        ip.sf_method = str(attrs['sf_method'])
+        ip.sf_tolerance = float(attrs['sf_tolerance'])
+        ip.raw_noise = float(attrs.get('raw_noise', 1.0))
+        ip.align = bool(attrs.get('align', False))
+        ip.calibration_roi = None
+        ip.profile = False
+        ip.timings = collections.OrderedDict()
+        ip.roi = None if roi is None else sel
+        if 'roi' in attrs:
+            saved = tuple(slice(*[int(x) for x in attrs['roi'][i:i + 3]]) for i in (0, 3))
+            ip.roi = _composerois(saved, sel)
+        ip._restore(state)
+        return ip
+
+    def preview(self, size=1000, func='mean'):
+        '''
+        returns a PSL image of at most size pixels along each axis for fast
+        previews. raw_hdr is reduced by `blockreduce` before the PSL
+        conversion, so the full image is never converted. Note that with
+        func='mean' the blocks are averaged in raw scale.
+        '''
+        factor = max(int(np.ceil(max(self.raw_hdr.shape) / float(size))), 1)
+        if factor == 1:
+            return self.psl
+        return self.topsl(blockreduce(self.raw_hdr, factor, func=func))
+
+    def pyramid(self, minsize=256, func='mean'):
+        '''
+        returns a list of PSL images, each reduced by a factor 2 with respect
+        to the previous one, until the smaller axis is below 2 * minsize.
+        The first entry is the full resolution image self.psl. Every level
+        is reduced from the previous level in raw scale, so this costs
+        little more than the first reduction.
+        '''
+        levels = [self.raw_hdr]
+        while min(levels[-1].shape) >= 2 * minsize:
+            levels.append(blockreduce(levels[-1], 2, func=func))
+        return [self.psl] + [self.topsl(level) for level in levels[1:]]
 
     def __array__(self, dtype=None):
         '''
         will be called by numpy function in case a numpy array is needed.
-        Contains the data in units of PSL.
+        Contains the data in units of PSL. Unless dtype needs a conversion,
+        this is the read-only array self.psl, use `getpsl` for a writable one.
         '''
         return np.asanyarray(self.psl, dtype=dtype)
 
     # Creats raw data, which is reduced by over- and underexposure
     def _getrealimg(self, n):
-        realimg = copy.copy(self.raw[n])
-        realimg[(realimg > self.rawsaturate) | (realimg < self.rawminimum)] = np.nan
-        return realimg
+        return _realimg(self.raw[n], self.rawminimum, self.rawsaturate, self.dtype)
+
+    def _sfname(self):
+        '''
+        the name of sf_method, which is stored in the cache key and files.
+        Callables are named by their module and qualified name. Names
+        containing '<' (lambdas, local functions and e.g. partials) do not
+        identify the function.
+        '''
+        if not callable(self.sf_method):
+            return self.sf_method
+        name = getattr(self.sf_method, '__qualname__', getattr(self.sf_method, '__name__', None))
+        if name is None:
+            return repr(self.sf_method)
+        return '{}.{}'.format(getattr(self.sf_method, '__module__', None), name)
+
+    # median and variance of the quotient between picture n and the following picture
+    def _ratiostats(self, n):
+        ratiostats = self.sf_method if callable(self.sf_method) \
+            else _RATIOSTATS[self.sf_method]
+        a, b = self._calibrationraw[n], self._calibrationraw[n + 1]
+        with self._stage('ratiostats[{}]'.format(n)):
+            return ratiostats(a, b, self.rawminimum, self.rawsaturate,
+                              dtype=self.dtype, tolerance=self.sf_tolerance,
+                              blocksize=self.blocksize)
 
     # Creats the quotient between picture n and the following picture
     def getimgquotient(self, n):
@@ -253,9 +1772,68 @@ class IPreader(Infreader):
             linplotdata = np.array([B[np.isfinite(B)].flatten(), A[np.isfinite(B)].flatten()])
             plt.plot(linplotdata[0, :], linplotdata[1, :], 'ro')
 
+    def getpsl(self, dtype=None, out=None):
+        '''
+        returns the HDR image converted to PSL as a new array of type dtype
+        (defaults to self.psl_dtype). If out is given, the result is
+        written to out instead. Unlike `psl`, this is calculated every time.
+        The HDR image of a single readout holds its counts unchanged, so it
+        is converted by the lookup table of `topsl`.
+        '''
+        with self._stage('psl'):
+            if out is None:
+                dtype = self.psl_dtype if dtype is None else dtype
+                out = np.empty(self.raw_hdr.shape, dtype=dtype)
+            return self.topsl(self.raw_hdr, out=out, lut=len(self.scalefactors) == 1 or None)
+
+    def clearpsl(self):
+        '''
+        discards the cached `psl` and `pslsigma`. This is done automatically
+        if raw_hdr, raw_var, psl_dtype or the readout settings are replaced,
+        but must be called after raw_hdr has been modified in place.
+        '''
+        self.__dict__.pop('_psl', None)
+        self.__dict__.pop('_pslsigma', None)
+
+    def getpslsigma(self, dtype=None, out=None):
+        '''
+        returns the standard deviation of every pixel of the PSL image as a
+        new array of type dtype (defaults to self.psl_dtype) or written to
+        out. It is propagated from self.raw_var through the logarithmic
+        PSL conversion: sigma_psl = psl * L * ln(10) / 65536 * sigma_raw.
+        Needs sigma=True.
+        '''
+        if self.raw_var is None:
+            raise ValueError('no variance accumulated. Use sigma=True.')
+        out = self.getpsl(dtype=dtype, out=out)
+        for s in _strips(out.shape[0], self.blocksize):
+            out[s] *= np.sqrt(self.raw_var[s]) * (self.L * np.log(10) / 65536.0)
+        return out
+
+    @property
+    def pslsigma(self):
+        if '_pslsigma' not in self.__dict__:
+            pslsigma = self.getpslsigma()
+            pslsigma.flags.writeable = False
+            self._pslsigma = pslsigma
+        return self._pslsigma
+
+    def __setattr__(self, name, value):
+        if name in ('raw_hdr', 'raw_var', 'psl_dtype', 'R', 'S', 'L'):
+            self.clearpsl()
+        Infreader.__setattr__(self, name, value)
+
     @property
     def psl(self):
-        return self.topsl(self.raw_hdr)
+        '''
+        the PSL image, cached on first access. It is read-only, as it is
+        shared by all accesses; use `getpsl` for a writable copy.
+        '''
+        if '_psl' not in self.__dict__:
+            psl = self.getpsl()
+            psl.flags.writeable = False  # shared by all accesses
+            self._psl = psl
+        return self._psl
 
     def __str__(self):
         return '<"' + str(self.files) + '" R:' + str(self.R) \
@@ -271,11 +1849,532 @@ class IPreader(Infreader):
     __repr__ = __str__
 
 
-def main():
+class IPstack(object):
+    '''
+    holds the HDR images of many image plates with identical geometry in a
+    single array self.raw_hdr of shape (plates, rows, cols), so a series of
+    shots can be analyzed with vectorized operations instead of a loop over
+    `IPreader` objects.
+
+    plates can be
+
+    - a directory. Its readouts are grouped into plates by `findplates`
+      using the regular expression pattern.
+    - a list, whose entries are the args of an `IPreader` (a single
+      filename, a glob pattern or a list of filenames) or IPreader objects.
+
+    All further kwargs are passed to `IPreader`. The plates are assembled
+    one after another directly into self.raw_hdr, so only a single plate is
+    held in memory besides it.
+
+    out is where to write self.raw_hdr to: an array of shape
+    (plates, rows, cols) or a filename, which will be created as memory
+    mapped `.npy` file. Defaults to None (a new array in memory).
+
+    The attributes are:
+
+    - self.raw_hdr - the HDR images in raw counts (see `IPreader`).
+    - self.plates - a numpy structured array with one row per plate holding
+      its metadata: name (the first filename without pattern), time (of the
+      first readout in seconds since the epoch), readouts and the read out
+      settings R, S and L.
+    - self.files, self.scalefactors, self.scalefactorsstd - lists with the
+      respective attribute of the IPreader of every plate.
+    - self.psl - all images converted to PSL. It is calculated on first
+      access only and cached afterwards. The cached array is read-only,
+      `getpsl` returns a writable copy.
+    '''
+
+    def __init__(self, plates, out=None, pattern=r'[_-]\d+$', **kwargs):
+        if not isinstance(plates, (list, tuple)):
+            plates = [[f + '.inf' for f in files]
+                      for files in findplates(plates, pattern=pattern)]
+        if len(plates) == 0:
+            raise ValueError('no image plates given.')
+        self.psl_dtype = kwargs.get('psl_dtype')
+        self.raw_hdr = None
+        self.files, self.scalefactors, self.scalefactorsstd = [], [], []
+        rows = []
+        for n, plate in enumerate(plates):
+            if isinstance(plate, IPreader):
+                ip = plate
+            else:
+                # later plates are assembled in place
+                kwargs['out'] = None if n == 0 else self.raw_hdr[n]
+                ip = IPreader(*(plate if isinstance(plate, (list, tuple)) else [plate]),
+                              **kwargs)
+            if self.raw_hdr is None:
+                self.R = ip.R
+                self.raw_hdr = _outarray(out, (len(plates),) + ip.raw_hdr.shape,
+                                         ip.raw_hdr.dtype)
+            elif ip.raw_hdr.shape != self.raw_hdr.shape[1:] or ip.R != self.R:
+                raise ValueError('Plate "{}" does not have the geometry of the first '
+                                 'plate.'.format(ip.files[0]))
+            # views of the same memory are not identical objects
+            if not np.shares_memory(ip.raw_hdr, self.raw_hdr[n]):
+                self.raw_hdr[n] = ip.raw_hdr
+            name = re.sub(pattern, '', os.path.basename(ip.files[0]))
+            rows.append((name, time.mktime(ip.time), len(ip.files), ip.R, ip.S, ip.L))
+            self.files.append(ip.files)
+            self.scalefactors.append(ip.scalefactors)
+            self.scalefactorsstd.append(ip.scalefactorsstd)
+        if self.psl_dtype is None:
+            self.psl_dtype = self.raw_hdr.dtype
+        width = max(len(row[0]) for row in rows)
+        self.plates = np.array(rows, dtype=[('name', 'U{}'.format(width)), ('time', 'f8'),
+                                            ('readouts', 'i4'), ('R', 'i4'),
+                                            ('S', 'f8'), ('L', 'f8')])
+        if isinstance(self.raw_hdr, np.memmap):
+            self.raw_hdr.flush()
+
+    def __len__(self):
+        return len(self.raw_hdr)
+
+    def __array__(self, dtype=None):
+        '''
+        will be called by numpy function in case a numpy array is needed.
+        Contains the data in units of PSL. Unless dtype needs a conversion,
+        this is the read-only array self.psl, use `getpsl` for a writable one.
+        '''
+        return np.asanyarray(self.psl, dtype=dtype)
+
+    def getpsl(self, dtype=None, out=None):
+        '''
+        returns all HDR images converted to PSL as a new array of type dtype
+        (defaults to self.psl_dtype). If out is given, the result is
+        written to out instead. All plates are converted at once in strips
+        of rows, each plate with its own read out settings.
+        '''
+        if out is None:
+            dtype = self.psl_dtype if dtype is None else dtype
+            out = np.empty(self.raw_hdr.shape, dtype=dtype)
+        R, S, L = [self.plates[s].astype(np.float64).reshape(-1, 1, 1) for s in 'RSL']
+        # about 4 MPix per strip
+        blocksize = max(2**22 // (self.raw_hdr.shape[0] * self.raw_hdr.shape[2]), 1)
+        for s in _strips(self.raw_hdr.shape[1], blocksize):
+            cnttopsl(self.raw_hdr[:, s], R, S, L, out=out[:, s])
+        return out
+
+    def clearpsl(self):
+        '''
+        discards the cached `psl`. This must be called after raw_hdr or
+        plates have been modified in place.
+        '''
+        self.__dict__.pop('_psl', None)
+
+    @property
+    def psl(self):
+        '''
+        the PSL image, cached on first access. It is read-only, as it is
+        shared by all accesses; use `getpsl` for a writable copy.
+        '''
+        if '_psl' not in self.__dict__:
+            psl = self.getpsl()
+            psl.flags.writeable = False  # shared by all accesses
+            self._psl = psl
+        return self._psl
+
+    def _roipsl(self, roi):
+        '''
+        yields the region of interest roi (see `IPreader`, defaults to the
+        full image) of all plates converted to PSL in strips of rows, so
+        neither the whole stack nor the whole region is converted at once.
+        '''
+        rows, cols = self.raw_hdr.shape[1:]
+        s = _roislices(np.s_[:, :] if roi is None else roi, rows, cols)
+        raw = self.raw_hdr[(slice(None),) + s]
+        R, S, L = [self.plates[k].astype(np.float64).reshape(-1, 1, 1) for k in 'RSL']
+        # about 4 MPix per strip
+        blocksize = max(2**22 // (raw.shape[0] * max(raw.shape[2], 1)), 1)
+        for strip in _strips(raw.shape[1], blocksize):
+            yield cnttopsl(raw[:, strip], R, S, L)
+
+    def roisum(self, roi=None):
+        '''
+        returns the sum of PSL within the region of interest roi (see
+        `IPreader`, defaults to the full image) of every plate.
+        '''
+        ret = np.zeros(len(self.raw_hdr))
+        for psl in self._roipsl(roi):
+            ret += np.sum(psl, axis=(1, 2))
+        return ret
+
+    def lineout(self, roi=None, axis=0):
+        '''
+        returns the mean PSL within the region of interest roi (see
+        `IPreader`, defaults to the full image) along the axis axis
+        (0: average over rows, 1: average over columns) of every plate as
+        array of shape (plates, length).
+        '''
+        if axis == 1:
+            return np.concatenate([np.mean(psl, axis=2) for psl in self._roipsl(roi)], axis=1)
+        ret, n = 0.0, 0
+        for psl in self._roipsl(roi):
+            ret = ret + np.sum(psl, axis=1)
+            n += psl.shape[1]
+        return ret / n
+
+    def __str__(self):
+        rows, cols = self.raw_hdr.shape[1:]
+        return '<{} plates rows:{} cols:{} R:{} "{}">'.format(
+            len(self), rows, cols, self.R, ', '.join(self.plates['name']))
+
+    __repr__ = __str__
+
+
+class Watcher(object):
+    '''
+    Watches directory for new readouts and assembles them as they come off
+    the scanner. Readouts are grouped into plates like in `findplates` and
+    every new readout is added to the `IPreader` of its plate by
+    `IPreader.add_readout`. After every update the PSL image of the plate
+    is saved as "<plate>.npy" and rendered to "<plate>.png" in outdir
+    (defaults to directory). Later plates sharing the name of an earlier
+    one (e.g. read with different settings) get the time of their first
+    readout appended like in `batch`. If log is True, the preview shows
+    log10(PSL).
+
+    A readout is picked up as soon as its .inf file can be parsed and its
+    .img file has the full size. Detection (polling every interval
+    seconds), assembly and rendering run in separate threads connected by
+    queues, so none of them blocks the others. If rendering falls behind,
+    only the latest image of each plate is rendered.
+
+    kwargs are forwarded to `IPreader.__init__()`.
+    '''
+
+    def __init__(self, directory, outdir=None, interval=1.0, pattern=r'[_-]\d+$',
+                 log=False, verbose=False, **kwargs):
+        self.directory = directory
+        self.outdir = directory if outdir is None else outdir
+        self.interval = interval
+        self.pattern = pattern
+        self.log = log
+        self.verbose = verbose
+        self.kwargs = kwargs
+        self.plates = {}  # maps the plate key to its IPreader
+        self.names = {}  # maps the plate key to its output name
+        self._seen = set()
+        self._stop = threading.Event()
+        self._readouts = queue.Queue()
+        self._renders = queue.Queue()
+        self._threads = []
+
+    def poll(self):
+        '''
+        returns Infreader objects of all complete readouts, which have not
+        been returned before, sorted by readout time.
+        '''
+        new = []
+        for filename in glob.glob(os.path.join(self.directory, '*.inf')):
+            if filename in self._seen:
+                continue
+            try:
+                inf = Infreader(filename)
+                complete = os.path.getsize(filename[:-4] + '.img') == 2 * inf.rows * inf.cols
+            except (IOError, OSError, IndexError, ValueError):
+                continue  # still being written, try again next time
+            if complete:
+                self._seen.add(filename)
+                new.append(inf)
+        new.sort(key=lambda inf: inf.time)
+        return new
+
+    def _assembleloop(self):
+        while True:
+            inf = self._readouts.get()
+            if inf is None:
+                self._renders.put(None)
+                return
+            key = _platekey(inf, self.pattern)
+            f = inf.filename[:-4]
+            try:
+                if key in self.plates:
+                    self.plates[key].add_readout(f)
+                else:
+                    # two names for the same file prevent globbing of f
+                    self.plates[key] = IPreader(f + '.inf', f + '.img', **self.kwargs)
+                    self.names[key] = self._outname(key[0], inf.time)
+                ip = self.plates[key]
+                self._renders.put((self.names[key], len(ip.files), ip.psl))
+            except Exception as e:
+                warnings.warn('Readout "{}" could not be added: {}'.format(f, e))
+
+    def _outname(self, name, t):
+        '''
+        returns the output name of a new plate named name, whose first
+        readout was made at t (struct_time). Names already given to other
+        plates are not reused, so their files are not overwritten.
+        '''
+        taken = set(self.names.values())
+        if name in taken:
+            name = '{}_{}'.format(name, time.strftime('%Y%m%d-%H%M%S', t))
+        ret, n = name, 0
+        while ret in taken:
+            n += 1
+            ret = '{}.{}'.format(name, n)
+        return ret
+
+    def _renderloop(self):
+        from matplotlib.image import imsave
+        stop = False
+        while not stop:
+            latest = {}
+            item = self._renders.get()
+            while True:  # collect all pending updates
+                if item is None:
+                    stop = True
+                else:
+                    latest[item[0]] = item
+                try:
+                    item = self._renders.get_nowait()
+                except queue.Empty:
+                    break
+            for name, readouts, psl in latest.values():
+                filename = os.path.join(self.outdir, name)
+                np.save(filename + '.npy', psl)
+                imsave(filename + '.png', np.log10(psl) if self.log else psl)
+                if self.verbose:
+                    print('{}: {} readout(s) -> {}.png'.format(name, readouts, filename))
+
+    def start(self):
+        '''
+        starts the assembly and rendering threads. New readouts are queued
+        by `run`.
+        '''
+        if not os.path.isdir(self.outdir):
+            os.makedirs(self.outdir)
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._assembleloop),
+                         threading.Thread(target=self._renderloop)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        '''
+        stops watching after all queued readouts have been processed.
+        '''
+        self._stop.set()
+        self._readouts.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def run(self, duration=None):
+        '''
+        watches the directory until `stop` is called, a KeyboardInterrupt
+        occurs or duration seconds have passed.
+        '''
+        self.start()
+        t0 = time.time()
+        try:
+            while not self._stop.is_set():
+                for inf in self.poll():
+                    self._readouts.put(inf)
+                if duration is not None and time.time() - t0 > duration:
+                    break
+                self._stop.wait(self.interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+def _printtimings(ip):
+    if not ip.profile:
+        return
+    print('{:16s} {:>10s} {:>12s} {:>12s}'.format('stage', 'time [s]', 'read [MiB]',
+                                                  'peak [MiB]'))
+    for stage, record in ip.timings.items():
+        peak = '-' if record['peak'] is None else '{:.1f}'.format(record['peak'] / 2.**20)
+        print('{:16s} {:10.4f} {:12.1f} {:>12s}'.format(stage, record['time'],
+                                                        record['bytes'] / 2.**20, peak))
+
+
+def _mainwatch(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='ipread watch',
+                                     description='Watches a directory for new image plate '
+                                     'readouts and keeps the assembled images and their '
+                                     'previews up to date. Stop with Ctrl-C.')
+    parser.add_argument('directory', help='directory the scanner writes to.')
+    parser.add_argument('-o', '--outdir', default=None,
+                        help='directory to write the .npy and .png files to. '
+                        'Defaults to the watched directory.')
+    parser.add_argument('-i', '--interval', type=float, default=1.0,
+                        help='seconds between two scans of the directory.')
+    parser.add_argument('--log', action='store_true',
+                        help='creates log10 previews instead of linear ones.')
+    args = parser.parse_args(argv)
+    Watcher(args.directory, outdir=args.outdir, interval=args.interval, log=args.log,
+            verbose=True).run()
+
+
+def _mainbatch(argv):
     import argparse
 
+    parser = argparse.ArgumentParser(prog='ipread batch',
+                                     description='Assembles all image plates '
+                                     'found in a directory. Readouts of the same plate '
+                                     'are grouped by their filename and read out settings.')
+    parser.add_argument('directory', help='directory containing the .inf and .img files.')
+    parser.add_argument('-o', '--outdir', default=None,
+                        help='directory to write the results and summary.txt to. '
+                        'Defaults to the input directory.')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='number of processes to use. Defaults to the number of cores.')
+    args = parser.parse_args(argv)
+    summaries = batch(args.directory, outdir=args.outdir, processes=args.processes)
+    for summary in summaries:
+        print('{plate}: {readouts} readouts'.format(**summary),
+              summary.get('error', summary.get('scalefactors')))
+
+
+def _assembletonpy(args):
+    '''
+    assembles the plate given by spec for `_mainplates` and writes its PSL
+    image to a memory mapped .npy file in directory, so it is not pickled
+    when handed back to the parent process. Returns a dict summarizing the
+    result.
+    '''
+    index, spec, directory, pattern = args
+    summary = dict(index=index, spec=spec)
+    try:
+        ip = IPreader(spec)
+        summary['plate'] = re.sub(pattern, '', os.path.basename(ip.files[0]))
+        summary['time'] = ip.time
+        summary['info'] = str(ip)
+        # named by index, as the names of the plates need not be unique
+        summary['output'] = os.path.join(directory, '{}.npy'.format(index))
+        psl = _outarray(summary['output'], ip.raw_hdr.shape, ip.psl_dtype)
+        ip.getpsl(out=psl)
+        psl.flush()
+    except Exception as e:
+        summary['error'] = '{}: {}'.format(type(e).__name__, e)
+    return summary
+
+
+def _renderpng(args):
+    '''
+    saves the PSL image stored in the .npy file filename as png image
+    pngfile, reduced to at most size pixels (see `blockreduce`) if given.
+    '''
+    filename, pngfile, log, size, func = args
+    from matplotlib.image import imsave
+    psl = np.load(filename, mmap_mode='r')
+    if size is not None:
+        psl = blockreduce(psl, max(int(np.ceil(max(psl.shape) / float(size))), 1), func)
+    imsave(pngfile, np.log10(psl) if log else psl)
+    return pngfile
+
+
+def _mainplates(argv):
+    import argparse
+    import shutil
+    import tempfile
+
+    parser = argparse.ArgumentParser(prog='ipread plates',
+                                     description='Assembles many image plates in parallel '
+                                     'and saves a .png image of each. Every plate is given '
+                                     'as a glob pattern matching its readouts, for example '
+                                     '"shot12_*".')
+    parser.add_argument('plates', nargs='+', help='one glob pattern per image plate.')
+    parser.add_argument('-o', '--outdir', default='.',
+                        help='directory to write the .png files to. Default: current '
+                        'directory.')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='number of processes to use. Defaults to the number of cores.')
+    parser.add_argument('--npy', action='store_true',
+                        help='also keep the PSL image of every plate as .npy file.')
+    parser.add_argument('--log', action='store_true',
+                        help='creates log10 images instead of linear ones.')
+    parser.add_argument('--size', type=int, default=None,
+                        help='reduce the images to at most size pixels along each axis.')
+    parser.add_argument('--reduce', choices=['mean', 'max'], default='mean',
+                        help='how blocks of pixels are combined by --size. Default: mean.')
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    # the PSL images are handed from the assembly to the rendering processes
+    # as memory mapped files instead of pickling them. The files are moved
+    # to outdir after all plates are done and their names are known.
+    tmpdir = tempfile.mkdtemp(prefix='ipread-', dir=args.outdir)
+    tasks = [(index, spec, tmpdir, r'[_-]\d+$') for index, spec in enumerate(args.plates)]
+
+    def render(summary):
+        return (summary['output'], summary['output'][:-4] + '.png',
+                args.log, args.size, args.reduce)
+
+    try:
+        if args.processes == 1:
+            summaries = [_assembletonpy(task) for task in tasks]
+            for summary in summaries:
+                if 'error' not in summary:
+                    _renderpng(render(summary))
+        else:
+            import multiprocessing
+            processes = args.processes or multiprocessing.cpu_count()
+            pool = multiprocessing.Pool(processes)
+            try:
+                summaries, results = [], []
+                # the tasks of the pool are started in the order they are queued.
+                # Queueing one assembly per process only and the next one after
+                # the render of a finished plate, renders start as soon as a
+                # process is free, while the other plates are still assembled.
+                pending, finished = list(reversed(tasks)), queue.Queue()
+
+                def assemblenext():
+                    pool.apply_async(_assembletonpy, (pending.pop(),), callback=finished.put)
+
+                for _ in range(min(processes, len(pending))):
+                    assemblenext()
+                while len(summaries) < len(tasks):
+                    summary = finished.get()  # _assembletonpy does not raise
+                    summaries.append(summary)
+                    if 'error' not in summary:
+                        results.append(pool.apply_async(_renderpng, (render(summary),)))
+                    if pending:
+                        assemblenext()
+                for result in results:
+                    result.get()
+            finally:
+                pool.close()
+                pool.join()
+        summaries.sort(key=lambda summary: summary['index'])
+        done = [summary for summary in summaries if 'error' not in summary]
+        names = _uniquenames([summary['plate'] for summary in done],
+                             [summary['time'] for summary in done])
+        renders = []
+        for summary, name in zip(done, names):
+            renders.append(os.path.join(args.outdir, name + '.png'))
+            _replace(summary['output'][:-4] + '.png', renders[-1])
+            if args.npy:
+                _replace(summary['output'], os.path.join(args.outdir, name + '.npy'))
+    finally:
+        shutil.rmtree(tmpdir)
+    for summary in summaries:
+        print('{}: {}'.format(summary['spec'], summary.get('error', summary.get('info'))))
+    return renders
+
+
+def main(argv=None):
+    import argparse
+    import sys
+
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) > 0 and argv[0] == 'batch':
+        return _mainbatch(argv[1:])
+    if len(argv) > 0 and argv[0] == 'watch':
+        return _mainwatch(argv[1:])
+    if len(argv) > 0 and argv[0] == 'plates':
+        return _mainplates(argv[1:])
+
     parser = argparse.ArgumentParser(description='Previews the Image Plate'
-                                     'readout(s) using matplotlib.')
+                                     'readout(s) using matplotlib. Use "ipread batch -h" '
+                                     'to see how to process whole directories, '
+                                     '"ipread watch -h" for live previews and '
+                                     '"ipread plates -h" to process many plates at once.')
     parser.add_argument('-V', '--version', action='version',
                         version=__version__)
     parser.add_argument('file', nargs='+',
@@ -285,6 +2384,21 @@ def main():
                         help='list properties of assembled image, dont '
                         'create any plots. No matplotlib is needed.',
                         action='store_true')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the time, bytes read and peak memory of every '
+                        'processing stage.')
+    parser.add_argument('--inf', action='store_true',
+                        help='only list the read out settings of all files. '
+                        'No .img file is read and nothing is assembled.')
+    parser.add_argument('--size', type=int, default=None,
+                        help='reduce the image to at most size pixels along each axis '
+                        'before plotting. This is much faster for large images.')
+    parser.add_argument('--reduce', choices=['mean', 'max'], default='mean',
+                        help='how blocks of pixels are combined by --size and --pyramid. '
+                        'Default: mean.')
+    parser.add_argument('--pyramid', metavar='filename', default=None,
+                        help='save a multi-resolution pyramid of the PSL image to the '
+                        '.npz file filename. Level n is reduced by 2**n.')
     parser.add_argument('--log',
                         help='creates a log10 plot instead of a linear one.',
                         action='store_true')
@@ -296,18 +2410,25 @@ def main():
     parser.add_argument('-v', '--verbose', action='count',
                         help='Verbose output. This shows an additional plot'
                         'to verify the scalefactors calculated')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     if args.save is None:
         args.save = args.file[0] + '.png'
     elif args.save == '':
         args.save = None
     # now args.save cointains the savename or None
 
-    ip = IPreader(*args.file)
+    if args.inf:
+        infs = [Infreader(f + '.inf') for f in _expandfiles(args.file)]
+        for inf in sorted(infs, key=lambda inf: inf.time):
+            print(inf)
+        return
+
+    ip = IPreader(*args.file, profile=args.profile)
     print(ip)
 
     if args.l:
-        exit()
+        _printtimings(ip)
+        return
 
     # create plots
     import matplotlib
@@ -315,17 +2436,23 @@ def main():
         matplotlib.use('Agg')
     import matplotlib.pyplot as plt
 
+    if args.pyramid:
+        np.savez(args.pyramid, *ip.pyramid(func=args.reduce))
+
     # data plot
+    psl = ip.psl if args.size is None else ip.preview(args.size, func=args.reduce)
     if args.log:
-        fig = plt.imshow(np.log10(ip.psl))
+        fig = plt.imshow(np.log10(psl))
     else:
-        fig = plt.imshow(ip.psl)
+        fig = plt.imshow(psl)
     plt.colorbar()
     if args.save:
         plt.savefig(args.save, dpi=400, transparent=True)
     else:
         plt.show(block=True)
 
+    _printtimings(ip)
+
     # scalefactor plot
     if args.verbose:
         ip.plotscalefactors()
@@ -8,10 +8,13 @@
 set -e
 
 
-pycodestyle ipread.py --statistics --count --show-source --ignore=W391 --max-line-length=99
+pycodestyle ipread.py benchmark.py --statistics --count --show-source --ignore=W391 --max-line-length=99
 
 python -m ipread -h
 
+# checks and runs all stages on small synthetic data, does not need network access
+python benchmark.py --rows 500 --cols 400 --repeat 1 --check
+
 mkdir -p _testdata
 cd _testdata
 
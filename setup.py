@@ -16,6 +16,7 @@ setup(name='ipread',
       py_modules=['ipread'],
       scripts=['scripts/ipread'],
       install_requires=['matplotlib', 'numpy', 'numexpr'],
+      extras_require={'hdf5': ['h5py']},
       license='GPL',
       classifiers=[
           'Intended Audience :: Science/Research',